@@ -0,0 +1,52 @@
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append('./')
+
+import torch
+import torchvision
+
+from utils.frame_store import decode_jpeg, decode_jpeg_batch
+
+def build_buffers(num_frames, image_size=512):
+    # smooth random images compress like natural frames, unlike pure noise
+    buffers = []
+    for _ in range(num_frames):
+        image = torch.rand(1, 3, image_size // 16, image_size // 16) * 255
+        image = torch.nn.functional.interpolate(image, size=image_size, mode='bicubic')[0]
+        image = torchvision.io.encode_jpeg(image.clamp(0, 255).to(torch.uint8))
+        buffers.append(image.numpy().tobytes())
+    return buffers
+
+
+def decode_loop(buffers):
+    # the previous DataEngine.get_frames path
+    frames = [decode_jpeg(buf) for buf in buffers]
+    return torch.utils.data.default_collate(frames)
+
+
+def timeit(func, repeat):
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', default=128, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--workers', default=[1, 2, 4, 8], type=int, nargs='+')
+    args = parser.parse_args()
+
+    buffers = build_buffers(args.batch_size)
+    used = timeit(lambda: decode_loop(buffers), args.repeat)
+    print('loop + default_collate : {:7.1f} ms/batch, {:7.1f} frames/s'.format(used * 1000, args.batch_size / used))
+    for workers in args.workers:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            used = timeit(lambda: decode_jpeg_batch(buffers, pool=pool), args.repeat)
+        print('thread pool ({:2d} workers): {:7.1f} ms/batch, {:7.1f} frames/s'.format(
+            workers, used * 1000, args.batch_size / used
+        ))
@@ -0,0 +1,61 @@
+import sys
+import time
+import types
+import argparse
+sys.path.append('./')
+
+import torch
+
+from core.lightning_engine import Lightning_Engine
+from core.fused_step import landmark_loss, CompiledStep
+from benchmark.bench_pose_solver import build_batch, reprojection_error
+
+def steps_per_second(func, steps, repeat):
+    # the first call compiles
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return steps * repeat / (time.perf_counter() - start), result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--steps', default=200, type=int)
+    parser.add_argument('--noise', default=1.5, type=float)
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--threads', default=0, type=int)
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    image_size = 512
+    batch_data, lmk_68, lmk_dense, init_pose, (focal_length, principal_point) = build_batch(
+        args.batch_size, 68, 105, image_size, args.noise, args.device
+    )
+    engine = Lightning_Engine('', device=args.device)
+    engine.image_size, engine.focal_length, engine.principal_point = image_size, focal_length, principal_point
+    # landmarks are already the mediapipe subset
+    engine.flame_model = types.SimpleNamespace(mediapipe_idx=torch.arange(lmk_dense.shape[1]))
+
+    results = []
+    eager_rate, (R, T) = steps_per_second(lambda: engine.adam_transform(
+        batch_data, lmk_68, lmk_dense, init_pose[0].clone(), init_pose[1].clone(), args.steps
+    ), args.steps, args.repeat)
+    results.append(('adam', eager_rate, R, T))
+    for compile_step in [False, True]:
+        engine._landmark_loss = CompiledStep(landmark_loss, enabled=compile_step)
+        rate, (R, T) = steps_per_second(lambda: engine.fused_transform(
+            batch_data, lmk_68, lmk_dense, init_pose[0].clone(), init_pose[1].clone(), args.steps
+        ), args.steps, args.repeat)
+        name = 'fused, compiled' if engine._landmark_loss.compiled else 'fused, eager'
+        results.append((name, rate, R, T))
+    print('Batch {}, {} steps, {} threads.'.format(args.batch_size, args.steps, torch.get_num_threads()))
+    for name, rate, R, T in results:
+        print('{:16s}: {:8.1f} steps/s, speedup {:.2f}x, reprojection error {:.3f}px'.format(
+            name, rate, rate / eager_rate, reprojection_error(engine, batch_data, lmk_68, lmk_dense, R, T)
+        ))
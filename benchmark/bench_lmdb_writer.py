@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+sys.path.append('./')
+
+import lmdb
+import numpy as np
+
+from utils.pipeline import LmdbWriter
+
+def build_buffers(num_frames, frame_bytes):
+    # random bytes do not compress, sizes are close to 512x512 jpeg frames
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 255, size=frame_bytes, dtype=np.uint8) for _ in range(num_frames)]
+
+
+def bench_legacy(lmdb_path, buffers):
+    env = lmdb.open(lmdb_path, map_size=1099511627776)
+    txn = env.begin(write=True)
+    start = time.perf_counter()
+    for f_idx, buf in enumerate(buffers):
+        img_name = 'f_{:07d}.jpg'.format(f_idx)
+        img_encoded = b''.join(map(lambda x:int.to_bytes(x,1,'little'), buf.tolist()))
+        if txn.get(img_name.encode()) is None:
+            txn.put(img_name.encode(), img_encoded)
+            if (f_idx + 1) % 1000 == 0:
+                txn.commit()
+                txn = env.begin(write=True)
+    txn.commit()
+    env.close()
+    return time.perf_counter() - start
+
+
+def bench_writer(lmdb_path, buffers, commit_every, write_batch):
+    start = time.perf_counter()
+    writer = LmdbWriter(lmdb_path, commit_every=commit_every, write_batch=write_batch)
+    for f_idx, buf in enumerate(buffers):
+        writer.put('f_{:07d}.jpg'.format(f_idx), buf)
+    writer.close()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', default=2000, type=int)
+    parser.add_argument('--frame_kb', default=60, type=int)
+    parser.add_argument('--skip_legacy', action='store_true')
+    args = parser.parse_args()
+
+    buffers = build_buffers(args.frames, args.frame_kb * 1024)
+    total_mb = sum(b.nbytes for b in buffers) / 1024 / 1024
+    print('Writing {} frames, {:.1f} MB.'.format(args.frames, total_mb))
+    root = tempfile.mkdtemp()
+    try:
+        if not args.skip_legacy:
+            used = bench_legacy(os.path.join(root, 'legacy'), buffers)
+            print('legacy (per-byte join + get/put): {:8.1f} MB/s'.format(total_mb / used))
+        for commit_every, write_batch in [(1000, 1), (1000, 64), (4000, 256)]:
+            lmdb_path = os.path.join(root, 'writer_{}_{}'.format(commit_every, write_batch))
+            used = bench_writer(lmdb_path, buffers, commit_every, write_batch)
+            print('LmdbWriter(commit={}, batch={}): {:8.1f} MB/s'.format(commit_every, write_batch, total_mb / used))
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,87 @@
+import sys
+import time
+import types
+import argparse
+sys.path.append('./')
+
+import torch
+
+from core.lightning_engine import Lightning_Engine
+from core.pose_solver import so3_exp
+from utils.projection import project_points
+
+def build_batch(batch_size, num_68, num_dense, image_size, noise, device):
+    # face-sized random landmarks (flame_scale=5), poses around the frontal view used by flame_to_camera
+    torch.manual_seed(0)
+    points = torch.randn(num_68 + num_dense, 3, device=device) * torch.tensor([0.5, 0.6, 0.25], device=device)
+    points = points[None].repeat(batch_size, 1, 1)
+    axis_angle = torch.randn(batch_size, 3, device=device) * 0.3
+    axis_angle[:, 1] += torch.pi
+    rotation = so3_exp(axis_angle)
+    translation = torch.randn(batch_size, 3, device=device) * 0.1
+    translation[:, 2] += 12.0
+    focal_length = torch.tensor([12.0], device=device)
+    principal_point = torch.tensor([0.02, -0.01], device=device)
+    target, _ = project_points(points, rotation, translation, focal_length, principal_point, image_size)
+    target = target + torch.randn_like(target) * noise
+    # the heuristic init is off by a few degrees and a few pixels
+    init_rotation = rotation @ so3_exp(torch.randn(batch_size, 3, device=device) * 0.05)
+    init_translation = translation + torch.randn(batch_size, 3, device=device) * 0.05
+    batch_data = {
+        'frame_names': ['f_{:07d}.jpg'.format(idx) for idx in range(batch_size)],
+        'emoca': {'lmks': target[:, :num_68], 'lmks_dense': target[:, num_68:]},
+    }
+    return batch_data, points[:, :num_68], points[:, num_68:], (init_rotation, init_translation), (focal_length, principal_point)
+
+
+def reprojection_error(engine, batch_data, lmk_68, lmk_dense, rotation, translation):
+    points = torch.cat([lmk_68, lmk_dense], dim=1)
+    target = torch.cat([batch_data['emoca']['lmks'], batch_data['emoca']['lmks_dense']], dim=1)
+    screen_points, _ = project_points(
+        points, rotation, translation, engine.focal_length, engine.principal_point, engine.image_size
+    )
+    return (screen_points - target).norm(dim=-1).mean().item()
+
+
+def timeit(func, repeat):
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', default=128, type=int)
+    parser.add_argument('--steps', default=200, type=int)
+    parser.add_argument('--lm_iters', default=10, type=int)
+    parser.add_argument('--noise', default=1.5, type=float)
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args()
+
+    image_size = 512
+    batch_data, lmk_68, lmk_dense, init_pose, (focal_length, principal_point) = build_batch(
+        args.batch_size, 68, 105, image_size, args.noise, args.device
+    )
+    engine = Lightning_Engine('', device=args.device, lm_iters=args.lm_iters)
+    engine.image_size, engine.focal_length, engine.principal_point = image_size, focal_length, principal_point
+    # landmarks are already the mediapipe subset
+    engine.flame_model = types.SimpleNamespace(mediapipe_idx=torch.arange(lmk_dense.shape[1]))
+    adam_time, (adam_R, adam_T) = timeit(lambda: engine.adam_transform(
+        batch_data, lmk_68, lmk_dense, init_pose[0].clone(), init_pose[1].clone(), args.steps
+    ), args.repeat)
+    lm_time, (lm_R, lm_T) = timeit(lambda: engine.solve_transform(
+        batch_data, lmk_68, lmk_dense, init_poses=[init_pose]
+    ), args.repeat)
+    print('Batch {}, noise {:.1f}px.'.format(args.batch_size, args.noise))
+    print('adam ({} steps): {:8.1f} ms/batch, reprojection error {:.3f}px'.format(
+        args.steps, adam_time * 1000, reprojection_error(engine, batch_data, lmk_68, lmk_dense, adam_R, adam_T)
+    ))
+    print('lm ({} iters):   {:8.1f} ms/batch, reprojection error {:.3f}px, speedup {:.1f}x'.format(
+        args.lm_iters, lm_time * 1000, reprojection_error(engine, batch_data, lmk_68, lmk_dense, lm_R, lm_T),
+        adam_time / lm_time
+    ))
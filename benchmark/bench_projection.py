@@ -0,0 +1,68 @@
+import sys
+import time
+import argparse
+sys.path.append('./')
+
+import torch
+from pytorch3d.renderer import PerspectiveCameras
+
+from utils.projection import project_points
+from core.pose_solver import so3_exp
+
+def build_cameras(batch_size, image_size, device):
+    # same construction as the engines' _build_cameras_kwargs
+    torch.manual_seed(0)
+    axis_angle = torch.randn(batch_size, 3, device=device) * 0.3
+    axis_angle[:, 1] += torch.pi
+    rotation = so3_exp(axis_angle)
+    translation = torch.randn(batch_size, 3, device=device) * 0.1
+    translation[:, 2] += 12.0
+    focal_length = torch.tensor([12.0], device=device)
+    principal_point = torch.tensor([0.02, -0.01], device=device)
+    screen_size = torch.tensor([image_size, image_size], device=device).float()[None].repeat(batch_size, 1)
+    cameras = PerspectiveCameras(
+        principal_point=principal_point.repeat(batch_size, 1), focal_length=focal_length,
+        image_size=screen_size, device=device
+    )
+    return cameras, rotation, translation, focal_length, principal_point
+
+
+def timeit(func, repeat):
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--num_points', default=173, type=int)
+    parser.add_argument('--repeat', default=200, type=int)
+    parser.add_argument('--tolerance', default=1e-3, type=float)
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args()
+
+    image_size = 512
+    cameras, rotation, translation, focal_length, principal_point = build_cameras(
+        args.batch_size, image_size, args.device
+    )
+    # face-sized landmarks (flame_scale=5)
+    points = torch.randn(args.batch_size, args.num_points, 3, device=args.device) * 0.5
+    pytorch3d_time, pytorch3d_points = timeit(
+        lambda: cameras.transform_points_screen(points, R=rotation, T=translation)[..., :2], args.repeat
+    )
+    analytic_time, (analytic_points, _) = timeit(
+        lambda: project_points(points, rotation, translation, focal_length, principal_point, image_size), args.repeat
+    )
+    error = (pytorch3d_points - analytic_points).abs().max().item()
+    print('Batch {}, {} points.'.format(args.batch_size, args.num_points))
+    print('max abs difference to pytorch3d: {:.2e}px'.format(error))
+    print('pytorch3d: {:8.3f} ms, analytic: {:8.3f} ms, speedup {:.1f}x'.format(
+        pytorch3d_time * 1000, analytic_time * 1000, pytorch3d_time / analytic_time
+    ))
+    if error > args.tolerance:
+        raise SystemExit('Projection differs from pytorch3d by {:.2e}px.'.format(error))
@@ -0,0 +1,101 @@
+import os
+import sys
+import time
+import argparse
+sys.path.append('./')
+
+import torch
+from pytorch3d.renderer import PerspectiveCameras
+
+from core.data_engine import DataEngine
+from core.synthesis_engine import Synthesis_Engine, pixel_loss
+from utils.projection import project_points
+
+FLAME_MODEL_PATH = './assets/FLAME'
+
+# Needs a video tracked with --synthesis (camera, lightning, texture and emoca results in outputs/).
+
+def load_batch(data_engine, frame_names, device):
+    batch_data = data_engine.get_frames(frame_names, keys=['lightning', 'emoca'], device=device)
+    batch_data['shape_code'] = data_engine.get_data('emoca_path', query_name='shape_code', device=device)
+    batch_data['texture_code'] = data_engine.get_data('texture_path', query_name='texture_params', device=device)
+    return batch_data
+
+
+@torch.no_grad()
+def evaluate(engine, batch_data, results):
+    # photometric error in the head mask and landmark error, both at full resolution
+    batch_size = len(batch_data['frame_names'])
+    transform_matrix = torch.stack([results[name]['transform_matrix'] for name in batch_data['frame_names']])
+    expression = torch.stack([results[name]['expression'] for name in batch_data['frame_names']])
+    transform_matrix, expression = transform_matrix.float().to(engine._device), expression.float().to(engine._device)
+    flame_pose = batch_data['lightning']['flame_pose'].clone()
+    flame_pose[..., :3] *= 0
+    engine.flame_model.bind_identity(batch_data['shape_code'])
+    flame_verts, pred_lmk_68, pred_lmk_dense = engine.flame_model(
+        shape_params=None, expression_params=expression, pose_params=flame_pose
+    )
+    flame_verts = flame_verts * engine.flame_scale
+    pred_lmk_68, pred_lmk_dense = pred_lmk_68 * engine.flame_scale, pred_lmk_dense * engine.flame_scale
+    rotation, translation = transform_matrix[:, :3, :3], transform_matrix[:, :3, 3]
+    cameras = PerspectiveCameras(R=rotation, T=translation, **engine._build_cameras_kwargs(batch_size))
+    albedos = engine.texture_cache.albedo(engine.flame_texture, batch_data['texture_code'])
+    pred_images, masks_all, _ = engine.mesh_render(flame_verts, albedos, cameras)
+    photometric = pixel_loss(pred_images, batch_data['frames'] / 255.0, mask=masks_all).item()
+    points_68, _ = project_points(
+        pred_lmk_68, rotation, translation, engine.focal_length, engine.principal_point, engine.image_size
+    )
+    points_dense, _ = project_points(
+        pred_lmk_dense, rotation, translation, engine.focal_length, engine.principal_point, engine.image_size
+    )
+    gt_dense = batch_data['emoca']['lmks_dense'][:, engine.flame_model.mediapipe_idx]
+    landmark = torch.cat([
+        (points_68 - batch_data['emoca']['lmks']).norm(dim=-1), (points_dense - gt_dense).norm(dim=-1)
+    ], dim=1).mean().item()
+    return photometric, landmark
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', required=True, type=str)
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--num_batches', default=4, type=int)
+    parser.add_argument('--steps', default=30, type=int)
+    parser.add_argument('--pyramid', default=[128, 256], type=int, nargs='+')
+    parser.add_argument('--device', default='cuda')
+    args = parser.parse_args()
+
+    data_name = os.path.splitext(os.path.basename(args.data))[0]
+    path_dict = {
+        'video_path': args.data, 'data_name': data_name, 'output_path': os.path.join('outputs', data_name),
+    }
+    data_engine = DataEngine(path_dict=path_dict, device=args.device)
+    camera_params = data_engine.get_data('camera_path', device=args.device)
+    frame_names = data_engine.frames()[:args.batch_size * args.num_batches]
+    mini_batchs = [frame_names[i:i + args.batch_size] for i in range(0, len(frame_names), args.batch_size)]
+
+    variants = [
+        ('fixed 512', {}), ('pyramid {}'.format(args.pyramid), {'pyramid': args.pyramid}),
+        ('face roi', {'face_roi': True}), ('face roi + pyramid', {'pyramid': args.pyramid, 'face_roi': True}),
+    ]
+    for name, engine_kwargs in variants:
+        engine = Synthesis_Engine(FLAME_MODEL_PATH, device=args.device, **engine_kwargs)
+        engine.init_model(camera_params, image_size=512)
+        # warm up
+        engine.synthesis_optimize(load_batch(data_engine, mini_batchs[0], args.device), steps=2)
+        used, photometric, landmark = 0.0, [], []
+        for batch_frames in mini_batchs:
+            batch_data = load_batch(data_engine, batch_frames, args.device)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            results = engine.synthesis_optimize(batch_data, steps=args.steps)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            used += time.perf_counter() - start
+            errors = evaluate(engine, load_batch(data_engine, batch_frames, args.device), results)
+            photometric.append(errors[0])
+            landmark.append(errors[1])
+        print('{:24s}: {:8.1f} ms/batch, photometric error {:.5f}, landmark error {:.3f}px'.format(
+            name, used / len(mini_batchs) * 1000, sum(photometric) / len(photometric), sum(landmark) / len(landmark)
+        ))
@@ -2,32 +2,32 @@ import math
 
 import torch
 import torchvision
-from tqdm.rich import tqdm
-from pytorch3d.renderer import look_at_view_transform, PerspectiveCameras
+from pytorch3d.renderer import look_at_view_transform
 from pytorch3d.transforms import matrix_to_rotation_6d, rotation_6d_to_matrix
 
 from model.FLAME.FLAME import FLAME_MP
+from utils.projection import project_points
+from .optim_loop import run_optimization
+from .fused_step import landmark_objective, landmark_loss, CompiledStep, FusedAdam
 
-def optimize_camera(emoca_params, frames, image_size=512, steps=1600, device='cuda'):
+def optimize_camera(emoca_params, frames, image_size=512, steps=1600, device='cuda', rel_tol=0.0, grad_tol=0.0, compile_step=False):
     # build params
     batch_size = emoca_params['shape'].shape[0]
     for key in emoca_params:
         emoca_params[key] = emoca_params[key].to(device).float()
     # build flame
     flame = FLAME_MP(flame_path = './assets/FLAME', n_shape=100, n_exp=50).to(device)
-    _, pred_lmk_68, pred_lmk_dense = flame(
+    pred_lmk_68, pred_lmk_dense = flame.forward_landmarks(
         shape_params=emoca_params['shape'], expression_params=emoca_params['exp'], pose_params=emoca_params['pose']
     )
     flame_scale = 5.0
     # build camera
-    screen_size = torch.tensor([image_size, image_size]).float().repeat(batch_size, 1).to(device)
     initial_focal_length = torch.tensor([[5000.0 / image_size]]).to(device)
-    cameras = PerspectiveCameras(device=device, image_size=screen_size)
     # build initilization params
     R, T = look_at_view_transform(dist=initial_focal_length)
     R = R.to(device).repeat(batch_size, 1, 1); T = T.to(device).repeat(batch_size, 1)
-    normed_lmks = cameras.transform_points_screen(
-        pred_lmk_dense*flame_scale, R=R, T=T, focal_length=initial_focal_length
+    normed_lmks, _ = project_points(
+        pred_lmk_dense*flame_scale, R, T, initial_focal_length, torch.zeros(1, 2).to(device), image_size
     )
     shifts = (normed_lmks.mean(dim=1)[..., :2] - emoca_params['lmks_dense'].mean(dim=1)) / image_size
     T[:, :2] = shifts * 2
@@ -38,19 +38,31 @@ def optimize_camera(emoca_params, frames, image_size=512, steps=1600, device='cu
     principal_point = torch.nn.Parameter(torch.zeros(1, 2).to(device), requires_grad=True)
     # optimizer
     params = [{'params': [camera_R, camera_T, focal_length, principal_point], 'lr': 0.05}]
-    optimizer = torch.optim.Adam(params)
+    if compile_step:
+        fused_loss = CompiledStep(landmark_loss)
+        optimizer = FusedAdam(params, compile=fused_loss.compiled)
+    else:
+        optimizer = torch.optim.Adam(params)
     scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=steps, gamma=0.1)
-
-    tqdm_queue = tqdm(range(steps), desc='', leave=True, miniters=100, ncols=120, colour='#95bb72')
-    for k in tqdm_queue:
-        points_68 = cameras.transform_points_screen(
-            pred_lmk_68*flame_scale,
-            R=rotation_6d_to_matrix(camera_R), T=camera_T, principal_point=principal_point, focal_length=focal_length
-        )[..., :2]
-        points_dense = cameras.transform_points_screen(
-            pred_lmk_dense*flame_scale,
-            R=rotation_6d_to_matrix(camera_R), T=camera_T, principal_point=principal_point, focal_length=focal_length
-        )[..., :2]
+    lmk_points, lmk_target, lmk_weights = landmark_objective(
+        pred_lmk_68*flame_scale, pred_lmk_dense*flame_scale,
+        emoca_params['lmks'], emoca_params['lmks_dense'][:, flame.mediapipe_idx], image_size
+    )
+    def fused_closure():
+        # one analytic projection for both landmark sets, points are projected after the loop
+        loss = fused_loss(
+            lmk_points, lmk_target, lmk_weights, camera_R, camera_T, focal_length, principal_point, image_size
+        )
+        return loss.sum() + torch.sum(principal_point ** 2)
+    points = {}
+    def closure():
+        rotation = rotation_6d_to_matrix(camera_R)
+        points_68, _ = project_points(
+            pred_lmk_68*flame_scale, rotation, camera_T, focal_length, principal_point, image_size
+        )
+        points_dense, _ = project_points(
+            pred_lmk_dense*flame_scale, rotation, camera_T, focal_length, principal_point, image_size
+        )
         losses = {}
         losses['pp_reg'] = torch.sum(principal_point ** 2)
         losses['lmk68'] = lmk_loss(points_68, emoca_params['lmks'], image_size) * 65
@@ -59,12 +71,17 @@ def optimize_camera(emoca_params, frames, image_size=512, steps=1600, device='cu
         for key in losses.keys():
             all_loss = all_loss + losses[key]
         losses['all_loss'] = all_loss
-        optimizer.zero_grad()
-        all_loss.backward()
-        optimizer.step()
-        scheduler.step()
-        loss = all_loss.item()
-        tqdm_queue.set_description(f'Loss(Camera): {loss:.4f}')
+        points['68'], points['dense'] = points_68.detach(), points_dense.detach()
+        return all_loss
+    _, sample_steps = run_optimization(
+        fused_closure if compile_step else closure, optimizer, steps, scheduler=scheduler, rel_tol=rel_tol, grad_tol=grad_tol,
+        desc='Camera', miniters=100
+    )
+    print('Camera calibration used {} steps.'.format(sample_steps.max().item()))
+    if compile_step:
+        with torch.no_grad():
+            closure()
+    points_68, points_dense = points['68'], points['dense']
     # visualization
     visualization = []
     for idx, frame in enumerate(frames):
@@ -1,6 +1,7 @@
 import os
 import sys
 import random
+import contextlib
 sys.path.append('./')
 
 import torch
@@ -13,6 +14,9 @@ from .emoca_engine import Emoca_Engine
 from .lightning_engine import Lightning_Engine
 from .synthesis_engine import Synthesis_Engine
 from .render_engine import Render_Engine
+from .optim_loop import step_summary
+from utils.pipeline import BackgroundIterator
+from utils.renderer import TextureCache
 
 FLAME_MODEL_PATH = './assets/FLAME'
 EMOCA_CKPT_PATH = './assets/EMOCA/EMOCA_v2_lr_mse_20/detail/checkpoints/deca-epoch=10-val_loss/dataloader_idx_0=3.25521111.ckpt'
@@ -28,12 +32,34 @@ class TrackEngine:
             'data_name': os.path.splitext(os.path.basename(self._args_config.data))[0],
             'output_path': os.path.join('outputs', os.path.splitext(os.path.basename(self._args_config.data))[0]),
         }
-        self.data_engine = DataEngine(path_dict=path_dict, device=self._device)
-        self.data_engine.build_data_lmdb(matting_thresh=self._args_config.matting_thresh)
+        self.data_engine = DataEngine(
+            path_dict=path_dict, device=self._device, frame_backend=self._args_config.frame_store,
+            decode_workers=self._args_config.decode_workers
+        )
+        self.data_engine.build_data_lmdb(
+            matting_thresh=self._args_config.matting_thresh, matting_batch=self._args_config.matting_batch,
+            num_workers=self._args_config.ingest_workers, commit_every=self._args_config.lmdb_commit,
+            num_segments=self._args_config.ingest_segments
+        )
         # lmks engine
-        self.emoca_engine = Emoca_Engine(EMOCA_CKPT_PATH, device=device, lazy_init=True)
-        self.lightning_engine = Lightning_Engine(FLAME_MODEL_PATH, device=device, lazy_init=True)
-        self.synthesis_engine = Synthesis_Engine(FLAME_MODEL_PATH, device=device, lazy_init=True)
+        self.emoca_engine = Emoca_Engine(
+            EMOCA_CKPT_PATH, device=device, lazy_init=True, track_face_box=args_config.track_face_box
+        )
+        self.lightning_engine = Lightning_Engine(
+            FLAME_MODEL_PATH, device=device, lazy_init=True,
+            solver=args_config.lightning_solver, lm_iters=args_config.lm_iters,
+            warm_start=args_config.warm_start, converge_tol=args_config.converge_tol, grad_tol=args_config.grad_tol,
+            compile_step=args_config.compile_step
+        )
+        # albedo maps of the frozen texture code, shared by synthesis and rendering
+        self.texture_cache = TextureCache()
+        self.synthesis_engine = Synthesis_Engine(
+            FLAME_MODEL_PATH, device=device, lazy_init=True,
+            converge_tol=args_config.converge_tol, grad_tol=args_config.grad_tol,
+            single_pass=args_config.single_pass_raster, texture_cache=self.texture_cache,
+            visible_texels=args_config.visible_texels, pyramid=args_config.synthesis_pyramid,
+            face_roi=args_config.face_roi
+        )
 
     def run(self, ):
         # emoca
@@ -44,7 +70,9 @@ class TrackEngine:
             cali_frames = random.choices(self.data_engine.frames(), k=32)
             batch_data = self.data_engine.get_frames(cali_frames, keys=['emoca'], device=self._device)
             camera_params, calibration_image = optimize_camera(
-                batch_data['emoca'], batch_data['frames'], device=self._device
+                batch_data['emoca'], batch_data['frames'], device=self._device,
+                rel_tol=self._args_config.converge_tol, grad_tol=self._args_config.grad_tol,
+                compile_step=self._args_config.compile_step
             )
             self.data_engine.save(camera_params, 'camera_path')
             self.data_engine.save(calibration_image/255.0, 'visul_calib_path')
@@ -70,38 +98,72 @@ class TrackEngine:
             self.data_engine.save(render_images, 'visul_path', fps=self._args_config.visualization_fps)
 
     def run_emoca(self, ):
-        shape_codes, emoca_results = [], {}
         print('EMOCA encoding...')
+        all_frames = self.data_engine.frames()
+        journal = self.data_engine.get_journal('emoca', fingerprint=self.data_engine.fingerprint([]))
+        done_frames = journal.done_frames()
+        todo_frames = [f for f in all_frames if f not in done_frames]
+        if len(done_frames):
+            print('Resume from journal: {} frames done, {} frames left.'.format(len(done_frames), len(todo_frames)))
         # processing
-        for frame_name in tqdm(self.data_engine.frames(), ncols=120, colour='#95bb72'):
-            frame = self.data_engine.get_frame(frame_name).float().to(self._device)
-            # landmarks = self.data_engine.get_data('lmks_path', query_name=frame_name, device=self._device)['lmks_dense']
-            emoca_res = self.emoca_engine.process_face(frame) # please input unnorm image
-            emoca_results[frame_name] = emoca_res
-            shape_codes.append(emoca_res['shape'])
-        shape_codes = torch.stack(shape_codes, dim=0).mean(dim=0)
+        if len(todo_frames) and self._args_config.emoca_workers > 1:
+            self.run_emoca_sharded(journal, todo_frames, self._args_config.emoca_workers, self._args_config.emoca_overlap)
+        elif len(todo_frames):
+            warmup_frames = self._warmup_frames(todo_frames[0], self._args_config.emoca_overlap)
+            emoca_shard(
+                self.emoca_engine, self.data_engine, journal, warmup_frames + todo_frames, len(warmup_frames),
+                self._args_config.emoca_batch, device=self._device, progress=True
+            )
+        emoca_store = journal.compact(all_frames)
+        emoca_results = emoca_store.frame_views()
+        shape_codes = emoca_store.gather(all_frames)['shape'].float().mean(dim=0)
         emoca_results['shape_code'] = shape_codes.cpu().half()
         print('Done.')
         return emoca_results
 
+    def _warmup_frames(self, frame_name, overlap):
+        # frames just before frame_name, used to warm up the stateful landmark trackers
+        all_frames = self.data_engine.frames()
+        frame_idx = all_frames.index(frame_name)
+        return all_frames[max(frame_idx - overlap, 0):frame_idx]
+
+    def run_emoca_sharded(self, journal, frame_names, num_workers, overlap):
+        # contiguous shards, each worker warms up its trackers on the frames before its shard
+        shard_size = (len(frame_names) + num_workers - 1) // num_workers
+        shard_args = []
+        for start in range(0, len(frame_names), shard_size):
+            warmup_frames = self._warmup_frames(frame_names[start], overlap)
+            shard_args.append((
+                warmup_frames + frame_names[start:start + shard_size], len(warmup_frames), self._args_config.emoca_batch,
+                self._args_config.track_face_box, max(torch.get_num_threads() // num_workers, 1), self._device,
+                self.data_engine, journal
+            ))
+        print('Running {} EMOCA shards...'.format(len(shard_args)))
+        mp_context = torch.multiprocessing.get_context('spawn')
+        with mp_context.Pool(len(shard_args)) as pool:
+            pool.starmap(emoca_shard_worker, shard_args)
+
     def run_lightning(self, ):
-        lightning_results = {}
         camera_params = self.data_engine.get_data('camera_path', device=self._device)
         self.lightning_engine.init_model(camera_params, image_size=512)
-        mini_batchs = build_minibatch(self.data_engine.frames(), 128)
+        self.lightning_engine.reset_warm_start()
+        journal = self.data_engine.get_journal(
+            'lightning', fingerprint=self.data_engine.fingerprint(['camera_path', 'emoca_path'])
+        )
+        mini_batchs = build_minibatch(self.todo_frames(journal), 128)
         print('Lightning tracking...')
-        for batch_frames in tqdm(mini_batchs, ncols=120, colour='#95bb72'):
-            batch_data = self.data_engine.get_frames(batch_frames, keys=['emoca'], device=self._device)
-            batch_data['shape_code'] = self.data_engine.get_data('emoca_path', query_name='shape_code', device=self._device)
-            lightning_res = self.lightning_engine.lightning_optimize(batch_data)
-            lightning_results.update(lightning_res)
+        with self.prefetch_batches(mini_batchs, keys=['emoca']) as batch_iter:
+            for batch_data in tqdm(batch_iter, total=len(mini_batchs), ncols=120, colour='#95bb72'):
+                lightning_res = self.lightning_engine.lightning_optimize(batch_data)
+                journal.append(lightning_res)
+        step_summary('Lightning', self.lightning_engine.step_log)
+        lightning_results = journal.compact(self.data_engine.frames()).frame_views()
         lightning_results['meta_info'] = camera_params
         lightning_results['meta_info']['shape_code'] = self.data_engine.get_data('emoca_path', query_name='shape_code').half()
         print('Done.')
         return lightning_results
 
     def run_synthesis(self, ):
-        synthesis_results = {}
         camera_params = self.data_engine.get_data('camera_path', device=self._device)
         self.synthesis_engine.init_model(camera_params, image_size=512)
         if not self.data_engine.check_path('texture_path'):
@@ -111,6 +173,7 @@ class TrackEngine:
             batch_data = self.data_engine.get_frames(random_frames, keys=['lightning'], device=self._device)
             batch_data['shape_code'] = self.data_engine.get_data('emoca_path', query_name='shape_code', device=self._device)
             tex_params, tex_image = self.synthesis_engine.optimize_texture(batch_data)
+            step_summary('Texture', self.synthesis_engine.texture_step_log)
             self.data_engine.save(tex_params, 'texture_path')
             self.data_engine.save(tex_image, 'visul_texture_path')
             tex_params = self.data_engine.get_data('texture_path', device=self._device)
@@ -118,14 +181,18 @@ class TrackEngine:
         else:
             tex_params = self.data_engine.get_data('texture_path', device=self._device)
 
-        mini_batchs = build_minibatch(self.data_engine.frames(), 64)
+        journal = self.data_engine.get_journal('synthesis', fingerprint=self.data_engine.fingerprint(
+            ['camera_path', 'emoca_path', 'lightning_path', 'texture_path']
+        ))
+        mini_batchs = build_minibatch(self.todo_frames(journal), 64)
         print('Synthesis tracking...')
-        for batch_frames in tqdm(mini_batchs, ncols=120, colour='#95bb72'):
-            batch_data = self.data_engine.get_frames(batch_frames, keys=['lightning', 'emoca'], device=self._device)
-            batch_data['texture_code'] = tex_params['texture_params'].clone()
-            batch_data['shape_code'] = self.data_engine.get_data('emoca_path', query_name='shape_code', device=self._device)
-            synthesis_res = self.synthesis_engine.synthesis_optimize(batch_data)
-            synthesis_results.update(synthesis_res)
+        with self.prefetch_batches(mini_batchs, keys=['lightning', 'emoca']) as batch_iter:
+            for batch_data in tqdm(batch_iter, total=len(mini_batchs), ncols=120, colour='#95bb72'):
+                batch_data['texture_code'] = tex_params['texture_params'].clone()
+                synthesis_res = self.synthesis_engine.synthesis_optimize(batch_data)
+                journal.append(synthesis_res)
+        step_summary('Synthesis', self.synthesis_engine.step_log)
+        synthesis_results = journal.compact(self.data_engine.frames()).frame_views()
         synthesis_results['meta_info'] = camera_params
         synthesis_results['meta_info']['shape_code'] = self.data_engine.get_data('emoca_path', query_name='shape_code')
         print('Done.')
@@ -135,20 +202,46 @@ class TrackEngine:
         with_texture = self._args_config.synthesis
         print('Rendering...')
         camera_params = self.data_engine.get_data('camera_path', device=self._device)
-        render_engine = Render_Engine(camera_params, FLAME_MODEL_PATH, with_texture=with_texture, device=self._device)
+        render_engine = Render_Engine(
+            camera_params, FLAME_MODEL_PATH, with_texture=with_texture, device=self._device,
+            texture_cache=self.texture_cache
+        )
         vis_images = []
         mini_batchs = build_minibatch(self.data_engine.frames()[:500], 64)
-        for batch_frames in tqdm(mini_batchs, ncols=120, colour='#95bb72'):
-            batch_data = self.data_engine.get_frames(batch_frames, keys=[anno_key], device=self._device)
-            if with_texture:
-                batch_data['texture_code'] = self.data_engine.get_data('texture_path', query_name='texture_params', device=self._device)
-            batch_data['shape_code'] = self.data_engine.get_data('emoca_path', query_name='shape_code', device=self._device)
-            vis_images += render_engine(batch_data, anno_key)
+        if with_texture:
+            texture_code = self.data_engine.get_data('texture_path', query_name='texture_params', device=self._device)
+        with self.prefetch_batches(mini_batchs, keys=[anno_key]) as batch_iter:
+            for batch_data in tqdm(batch_iter, total=len(mini_batchs), ncols=120, colour='#95bb72'):
+                if with_texture:
+                    batch_data['texture_code'] = texture_code
+                vis_images += render_engine(batch_data, anno_key)
+        # rendering is the last stage that reads the albedo maps
+        self.texture_cache.clear()
         # vis_images = [i.to(torch.uint8).cpu() for i in vis_images]
         vis_images = torch.stack(vis_images, dim=0).permute(0, 2, 3, 1)
         print('Done.')
         return vis_images
 
+    def todo_frames(self, journal):
+        done_frames = journal.done_frames()
+        if len(done_frames):
+            print('Resume from journal: {} frames done.'.format(len(done_frames)))
+        return [f for f in self.data_engine.frames() if f not in done_frames]
+
+    def prefetch_batches(self, mini_batchs, keys):
+        # load minibatch k+1 (lmdb read, decode, collate, annotations) while minibatch k is optimized
+        def load_batch(batch_frames):
+            batch_data = self.data_engine.get_frames(batch_frames, keys=keys, device=self._device)
+            batch_data['shape_code'] = self.data_engine.get_data('emoca_path', query_name='shape_code', device=self._device)
+            return batch_data
+        # load the annotations once here, not concurrently from the loader thread
+        for k in keys + ['emoca']:
+            self.data_engine.get_results(k)
+        # used as a context manager, the loader thread is stopped when the consumer leaves the loop
+        if self._args_config.prefetch <= 0:
+            return contextlib.nullcontext(map(load_batch, mini_batchs))
+        return BackgroundIterator(map(load_batch, mini_batchs), max_size=self._args_config.prefetch)
+
     def run_smoothing(self, anno_key='synthesis', type='exponential'):
         from pytorch3d.transforms import matrix_to_rotation_6d, rotation_6d_to_matrix
         def smooth_params(data, alpha=0.5, type=type):
@@ -191,6 +284,31 @@ class TrackEngine:
         return smoothed_results
 
 
+def emoca_shard(emoca_engine, data_engine, journal, frame_names, num_warmup, batch_size, device='cpu', progress=False):
+    # the first num_warmup frames only warm up the tracking state, the others are journaled per minibatch
+    mini_batchs = build_minibatch(frame_names, batch_size)
+    warmup_frames = set(frame_names[:num_warmup])
+    if progress:
+        mini_batchs = tqdm(mini_batchs, ncols=120, colour='#95bb72')
+    for batch_frames in mini_batchs:
+        frames = data_engine.get_frames(batch_frames, device=device)['frames']
+        # landmarks = self.data_engine.get_data('lmks_path', query_name=frame_name, device=self._device)['lmks_dense']
+        batch_res = emoca_engine.process_faces(frames) # please input unnorm image
+        journal.append({
+            frame_name: emoca_res for frame_name, emoca_res in zip(batch_frames, batch_res)
+            if frame_name not in warmup_frames
+        })
+
+
+def emoca_shard_worker(
+        frame_names, num_warmup, batch_size, track_face_box, num_threads, device, data_engine, journal
+    ):
+    # own process, own detectors
+    torch.set_num_threads(num_threads)
+    emoca_engine = Emoca_Engine(EMOCA_CKPT_PATH, device=device, lazy_init=True, track_face_box=track_face_box)
+    emoca_shard(emoca_engine, data_engine, journal, frame_names, num_warmup, batch_size, device=device)
+
+
 def build_minibatch(all_frames, batch_size=32):
     all_mini_batch, mini_batch = [], []
     for frame_name in all_frames:
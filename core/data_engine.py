@@ -1,22 +1,36 @@
 import os
 import json
+import queue
+import hashlib
+import threading
+import itertools
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
 import lmdb
 import torch
-import numpy as np
 import torchvision
 from tqdm.rich import tqdm
 
 from model.SGHM import HumanMatting
 from utils.utils import pretty_dict
+from utils.pipeline import BackgroundIterator, LmdbWriter
+from utils.journal import ResultJournal
+from utils.result_store import ResultStore, PthResultStore
+from utils.frame_store import RawFrameStore, decode_jpeg, decode_jpeg_batch
 
 SGHM_CKPT_PATH = './assets/SGHM/SGHM-ResNet50.pth'
+RESULT_STAGES = ['emoca', 'lightning', 'synthesis', 'smoothed']
 
 class DataEngine:
-    def __init__(self, path_dict, device='cpu'):
+    def __init__(self, path_dict, device='cpu', frame_backend='lmdb', decode_workers=4):
+        assert frame_backend in ['lmdb', 'raw'], frame_backend
         self.device = device
+        self.frame_backend = frame_backend
+        self.decode_workers = decode_workers
         self.path_dict = path_dict
         self.path_dict['dataset_path'] = os.path.join(path_dict['output_path'], 'lmdb')
+        self.path_dict['frame_store_path'] = os.path.join(path_dict['output_path'], 'frames_raw')
         # self.path_dict['lmks_path'] = os.path.join(path_dict['output_path'], 'landmarks.pth')
         self.path_dict['emoca_path'] = os.path.join(path_dict['output_path'], 'emoca.pth')
         self.path_dict['camera_path'] = os.path.join(path_dict['output_path'], 'camera_params.pth')
@@ -28,52 +42,136 @@ class DataEngine:
         self.path_dict['visul_data_path'] = os.path.join(path_dict['output_path'], 'data_vis.mp4')
         self.path_dict['visul_calib_path'] = os.path.join(path_dict['output_path'], 'calibration.jpg')
         self.path_dict['visul_texture_path'] = os.path.join(path_dict['output_path'], 'texture.jpg')
+        for stage in RESULT_STAGES:
+            self.path_dict['{}_store_path'.format(stage)] = os.path.join(path_dict['output_path'], stage+'_store')
+        for stage in ['emoca', 'lightning', 'synthesis']:
+            self.path_dict['journal_{}_path'.format(stage)] = os.path.join(path_dict['output_path'], 'journal_'+stage)
 
     def __str__(self, ):
         return pretty_dict(self.path_dict)
 
     def get_frame(self, frame_name, channel=3):
-        if not hasattr(self, '_dataset_lmdb_env'):
+        if self.frame_backend == 'raw' and channel == 3:
+            return self._get_frame_store().get_frame(frame_name)
+        return self._decode_frame(frame_name, channel=channel)
+
+    def _get_lmdb_txn(self, ):
+        # lmdb environments must not cross processes, read transactions must not cross threads
+        if getattr(self, '_dataset_lmdb_pid', None) != os.getpid():
             self._dataset_lmdb_env = lmdb.open(
                 self.path_dict['dataset_path'], readonly=True, lock=False, readahead=False, meminit=True
             ) 
-            self._dataset_lmdb_txn = self._dataset_lmdb_env.begin(write=False)
-        # load image as [channel(RGB), image_height, image_width]
-        _mode = torchvision.io.ImageReadMode.RGB if channel == 3 else torchvision.io.ImageReadMode.GRAY
-        image_buf = self._dataset_lmdb_txn.get(frame_name.encode())
-        image_buf = torch.tensor(np.frombuffer(image_buf, dtype=np.uint8))
-        image = torchvision.io.decode_image(image_buf, mode=_mode)
+            self._dataset_lmdb_pid = os.getpid()
+            self._dataset_lmdb_local = threading.local()
+        if not hasattr(self._dataset_lmdb_local, 'txn'):
+            self._dataset_lmdb_local.txn = self._dataset_lmdb_env.begin(write=False)
+        return self._dataset_lmdb_local.txn
+
+    def __getstate__(self, ):
+        # drop process-local handles, they are reopened lazily in the new process
+        state = self.__dict__.copy()
+        for key in [
+                '_dataset_lmdb_env', '_dataset_lmdb_pid', '_dataset_lmdb_local', '_decode_pool', '_frame_store',
+                '_journals', '_result_stores', 'matting_engine'
+            ]:
+            state.pop(key, None)
+        # loaded results are reloaded on demand as well
+        for key in list(state.keys()):
+            if key.endswith('_data'):
+                state.pop(key)
+        return state
+
+    def _decode_frame(self, frame_name, channel=3):
+        image_buf = self._get_lmdb_txn().get(frame_name.encode())
+        image = decode_jpeg(image_buf, channel=channel)
         # image = torchvision.io.read_image(frame_name, mode=_mode)
         assert image is not None, frame_name
         return image
 
+    def _decode_frames(self, frame_names, channel=3):
+        txn = self._get_lmdb_txn()
+        image_bufs = [txn.get(f.encode()) for f in frame_names]
+        if self.decode_workers > 1 and not hasattr(self, '_decode_pool'):
+            self._decode_pool = ThreadPoolExecutor(max_workers=self.decode_workers)
+        return decode_jpeg_batch(image_bufs, channel=channel, pool=getattr(self, '_decode_pool', None))
+
+    def _get_frame_store(self, ):
+        if not hasattr(self, '_frame_store'):
+            self._frame_store = RawFrameStore(self.path_dict['frame_store_path'])
+        return self._frame_store
+
     def get_frames(self, frame_names, channel=3, keys=[], *, device='cpu'):
-        results = {'frame_names': [], 'frames': []}
+        results = {'frame_names': list(frame_names)}
         for k in keys:
-            results[k] = []
-        for f in frame_names:
-            for k in keys:
-                results[k].append(self.get_data(k+'_path', query_name=f))
-            results['frames'].append(self.get_frame(f, channel=channel))
-            results['frame_names'].append(f)
-        results['frames'] = torch.utils.data.default_collate(results['frames'])
-        for k in keys:
-            results[k] = torch.utils.data.default_collate(results[k])
+            # one gather per field
+            results[k] = self.get_results(k).gather(frame_names)
+        if self.frame_backend == 'raw' and channel == 3:
+            # zero-copy view for contiguous frames
+            results['frames'] = self._get_frame_store().get_frames(frame_names)
+        else:
+            results['frames'] = self._decode_frames(frame_names, channel=channel)
         results = move_to(results, dtype=torch.float32, device=device)
         return results
 
-    def get_data(self, path_key, device='cpu', *, query_name=None):
+    def load_data(self, path_key):
         if not hasattr(self, path_key.replace('path', 'data')):
             setattr(
                 self, path_key.replace('path', 'data'), 
                 torch.load(self.path_dict[path_key], map_location='cpu')
             )
-        data = getattr(self, path_key.replace('path', 'data'))
+        return getattr(self, path_key.replace('path', 'data'))
+
+    def get_results(self, stage):
+        # columnar results of a tracking stage, old runs only have the .pth
+        if not hasattr(self, '_result_stores'):
+            self._result_stores = {}
+        if stage not in self._result_stores:
+            store_path, pth_path = self.path_dict[stage+'_store_path'], self.path_dict[stage+'_path']
+            stale = os.path.exists(pth_path) and not ResultStore.exists(store_path, pth_path)
+            if ResultStore.exists(store_path) and stale:
+                # the .pth changed after the store was built (crash in between, or replaced by hand)
+                print('Rebuilding {} from {}.'.format(store_path, pth_path))
+                ResultStore.build(store_path, torch.load(pth_path, map_location='cpu'), self.frames(), pth_path)
+            if ResultStore.exists(store_path):
+                self._result_stores[stage] = ResultStore(store_path)
+            else:
+                self._result_stores[stage] = PthResultStore(self.path_dict[stage+'_path'], self.frames())
+        return self._result_stores[stage]
+
+    def get_data(self, path_key, device='cpu', *, query_name=None):
+        stage = path_key[:-len('_path')]
+        if stage in RESULT_STAGES and query_name is not None:
+            results = self.get_results(stage)
+            if query_name in results:
+                return move_to(results.get_frame(query_name), dtype=torch.float32, device=device)
+            return move_to(results.meta[query_name], dtype=torch.float32, device=device)
+        data = self.load_data(path_key)
         if query_name is None:
             return move_to(data, dtype=torch.float32, device=device)
         else:
             return move_to(data[query_name], dtype=torch.float32, device=device)
 
+    def get_journal(self, stage, fingerprint=None):
+        # one environment per journal and process
+        if not hasattr(self, '_journals'):
+            self._journals = {}
+        if stage not in self._journals:
+            self._journals[stage] = ResultJournal(self.path_dict['journal_{}_path'.format(stage)], fingerprint)
+        return self._journals[stage]
+
+    def fingerprint(self, path_keys):
+        # content hash of the upstream results of a stage, and of the frames it runs on
+        sha = hashlib.sha1('\n'.join(self.frames()).encode())
+        for path_key in path_keys:
+            with open(self.path_dict[path_key], 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 24), b''):
+                    sha.update(chunk)
+        return sha.hexdigest()
+
+    def remove_journal(self, stage):
+        self.get_journal(stage).remove()
+        del self._journals[stage]
+
     def check_path(self, path_key):
         if os.path.exists(self.path_dict[path_key]):
             print('Found {}.'.format(self.path_dict[path_key]))
@@ -83,7 +181,21 @@ class DataEngine:
 
     def save(self, data, path_key, **kwargs):
         if '.pth' in self.path_dict[path_key]:
-            torch.save(data, self.path_dict[path_key])
+            stage = path_key[:-len('_path')]
+            # the stage journal is invalidated between writing the .pth aside and moving it in place,
+            # so a journal is never resumed next to a saved result
+            torch.save(data, self.path_dict[path_key]+'.tmp')
+            if stage in getattr(self, '_journals', {}):
+                self._journals[stage].invalidate()
+            os.replace(self.path_dict[path_key]+'.tmp', self.path_dict[path_key])
+            if stage in RESULT_STAGES:
+                ResultStore.build(
+                    self.path_dict[stage+'_store_path'], data, self.frames(), source_path=self.path_dict[path_key]
+                )
+                if hasattr(self, '_result_stores'):
+                    self._result_stores.pop(stage, None)
+            if stage in getattr(self, '_journals', {}):
+                self.remove_journal(stage)
         elif '.json' in self.path_dict[path_key]:
             with open(self.path_dict[path_key], "w") as f:
                 json.dump(data, f)
@@ -94,60 +206,138 @@ class DataEngine:
         elif '.jpg' in self.path_dict[path_key]:
             torchvision.utils.save_image(data, self.path_dict[path_key], nrow=4)
 
-    def build_data_lmdb(self, matting_thresh):
+    def build_data_lmdb(
+            self, matting_thresh, matting_batch=1, num_workers=4, queue_size=32, commit_every=1000, num_segments=1
+        ):
         if not os.path.exists(self.path_dict['dataset_path']):
-            self.matting_engine = RobustMattingEngine(device=self.device)
-            print('Decoding video.....')
-            video = torchvision.io.VideoReader(self.path_dict['video_path'], 'video')
-            meta_data = video.get_metadata()
-            approx_len = int(meta_data['video']['duration'][0] * meta_data['video']['fps'][0]) + 1
             print('Dumpling video to buffer lmdb.....')
             os.makedirs(self.path_dict['dataset_path'])
-            env = lmdb.open(self.path_dict['dataset_path'], map_size=1099511627776) # Maximum 1T
-            txn = env.begin(write=True)
-            counter = 0
-            visulization, writed = [], False
-            for f_idx, frame in enumerate(tqdm(video, ncols=80, colour='#95bb72', total=approx_len)):
-                frame = frame['data']
-                frame = self.matting_engine.matting(frame, thresh=matting_thresh)
-                frame = torchvision.transforms.functional.resize(frame, size=512, antialias=True)
-                frame = torchvision.transforms.functional.center_crop(frame, output_size=512).float()
-                if f_idx % 3 == 0 and len(visulization) < 100:
-                    visulization.append(frame.cpu())
-                elif len(visulization) >= 100 and not writed:
-                    visulization = torch.stack(visulization, dim=0).permute(0, 2, 3, 1)
-                    torchvision.io.write_video(
-                        self.path_dict['visul_data_path'], visulization, fps=10
+            writer = LmdbWriter(self.path_dict['dataset_path'], queue_size=queue_size, commit_every=commit_every)
+            visulization = {}
+            try:
+                if num_segments > 1:
+                    self._ingest_segments(
+                        writer, visulization, matting_thresh, matting_batch, num_workers, num_segments, queue_size
                     )
-                    writed = True
-                img_name = 'f_{:07d}.jpg'.format(f_idx)
-                img_encoded = torchvision.io.encode_jpeg(frame.to(torch.uint8))
-                img_encoded = b''.join(map(lambda x:int.to_bytes(x,1,'little'), img_encoded.numpy().tolist()))
-                buf = txn.get(img_name.encode())
-                if buf is not None:
-                    print('Exsist!', img_name)
-                    continue
                 else:
-                    txn.put(img_name.encode(), img_encoded)
-                    counter += 1
-                    if counter % 1000 == 0:
-                        txn.commit()
-                        txn = env.begin(write=True)
-            txn.commit()
-            env.close()
+                    self._ingest_sequential(writer, visulization, matting_thresh, matting_batch, num_workers, queue_size)
+            finally:
+                writer.close()
+            if len(visulization) >= 100:
+                visulization = [visulization[k] for k in sorted(visulization.keys())]
+                visulization = torch.stack(visulization, dim=0).permute(0, 2, 3, 1)
+                torchvision.io.write_video(
+                    self.path_dict['visul_data_path'], visulization, fps=10
+                )
             print('Data has been built.')
         else:
             print('Load buffered data.')
+        if self.frame_backend == 'raw':
+            self.build_frame_store()
+
+    def _ingest_sequential(self, writer, visulization, matting_thresh, matting_batch, num_workers, queue_size):
+        self.matting_engine = RobustMattingEngine(device=self.device)
+        print('Decoding video.....')
+        video = torchvision.io.VideoReader(self.path_dict['video_path'], 'video')
+        meta_data = video.get_metadata()
+        approx_len = int(meta_data['video']['duration'][0] * meta_data['video']['fps'][0]) + 1
+        # decode (thread) -> matte (this thread) -> resize/crop/encode (pool) -> lmdb (writer thread)
+        encode_pool = ThreadPoolExecutor(max_workers=num_workers)
+        decoder = BackgroundIterator((frame['data'] for frame in video), max_size=queue_size)
+        video_frames = tqdm(decoder, ncols=80, colour='#95bb72', total=approx_len)
+        matted_frames = (
+            frame for frame_batch in batch_iter(video_frames, matting_batch)
+            for frame in self.matting_engine.matting_batch(frame_batch, thresh=matting_thresh)
+        )
+        try:
+            for f_idx, frame in enumerate(matted_frames):
+                img_name = 'f_{:07d}.jpg'.format(f_idx)
+                writer.put(img_name, encode_pool.submit(self._encode_frame, frame, f_idx, visulization))
+        finally:
+            decoder.close()
+            encode_pool.shutdown(wait=True)
+
+    def _ingest_segments(
+            self, writer, visulization, matting_thresh, matting_batch, num_workers, num_segments, queue_size
+        ):
+        # every worker decodes, mattes and encodes one keyframe-aligned segment,
+        # the num_workers encode threads are split between the segments
+        segments = find_video_segments(self.path_dict['video_path'], num_segments)
+        total_frames = sum([seg['num_frames'] for seg in segments])
+        print('Decoding video in {} segments.....'.format(len(segments)))
+        mp_context = torch.multiprocessing.get_context('spawn')
+        results = mp_context.Queue(maxsize=queue_size)
+        num_threads = max(torch.get_num_threads() // len(segments), 1)
+        encode_workers = max(num_workers // len(segments), 1)
+        workers = []
+        for seg in segments:
+            worker = mp_context.Process(
+                target=ingest_segment, daemon=True,
+                args=(
+                    self.path_dict['video_path'], seg, matting_thresh, matting_batch, num_threads, encode_workers,
+                    self.device, results
+                )
+            )
+            worker.start()
+            workers.append(worker)
+        try:
+            finished = 0
+            progress = tqdm(total=total_frames, ncols=80, colour='#95bb72')
+            while finished < len(workers):
+                try:
+                    item = results.get(timeout=10)
+                except queue.Empty:
+                    # workers put None before a clean exit, anything else means it was killed
+                    for worker in workers:
+                        if not worker.is_alive() and worker.exitcode != 0:
+                            raise RuntimeError(
+                                'Ingest worker {} died with exit code {}.'.format(worker.pid, worker.exitcode)
+                            )
+                    continue
+                if item is None:
+                    finished += 1
+                    continue
+                if isinstance(item, BaseException):
+                    raise item
+                img_name, img_encoded, f_idx, vis_frame = item
+                if vis_frame is not None:
+                    visulization[f_idx] = vis_frame
+                writer.put(img_name, img_encoded)
+                progress.update(1)
+            progress.close()
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+
+    @staticmethod
+    def _encode_frame(frame, f_idx, visulization):
+        frame = torchvision.transforms.functional.resize(frame, size=512, antialias=True)
+        frame = torchvision.transforms.functional.center_crop(frame, output_size=512).float()
+        if f_idx % 3 == 0 and f_idx < 300:
+            visulization[f_idx] = frame.cpu()
+        img_encoded = torchvision.io.encode_jpeg(frame.to(torch.uint8))
+        # hand the encoded buffer to the writer without copying it into python objects
+        return img_encoded.numpy()
+
+    def build_frame_store(self, ):
+        # decode every jpeg once into the memory-mapped raw frame store
+        if RawFrameStore.exists(self.path_dict['frame_store_path']):
+            return
+        print('Building raw frame store.....')
+        frame_names = self.frames()
+        frame_shape = tuple(self._decode_frame(frame_names[0]).shape)
+        RawFrameStore.build(
+            self.path_dict['frame_store_path'], frame_names,
+            (self._decode_frame(f) for f in tqdm(frame_names, ncols=80, colour='#95bb72')), frame_shape
+        )
+        print('Done.')
 
     def frames(self, ):
-        if not hasattr(self, '_dataset_lmdb_env'):
-            self._dataset_lmdb_env = lmdb.open(
-                self.path_dict['dataset_path'], readonly=True, lock=False, readahead=False, meminit=True
-            ) 
-            self._dataset_lmdb_txn = self._dataset_lmdb_env.begin(write=False)
         if not hasattr(self, '_frames'):
             frames = []
-            all_keys = list(self._dataset_lmdb_txn.cursor().iternext(values=False))
+            all_keys = list(self._get_lmdb_txn().cursor().iternext(values=False))
             frames = [key.decode() for key in all_keys]
             print('Load data, length:{}.'.format(len(frames)))
             frames.sort(key=lambda x:int(x[2:-4]))
@@ -168,10 +358,8 @@ class RobustMattingEngine:
         print('Matting Model Build done.')
         self.rec_frames = [None] * 4
 
-    @torch.no_grad()
-    def matting(self, frame, thresh=0.3, background=[255, 255, 255]):
-        infer_size = 1280
-        h, w = frame.shape[1], frame.shape[2]
+    @staticmethod
+    def _infer_size(h, w, infer_size=1280):
         if w >= h:
             rh = infer_size
             rw = int(w / h * infer_size)
@@ -179,14 +367,29 @@ class RobustMattingEngine:
             rw = infer_size
             rh = int(h / w * infer_size)
         rh = rh - rh % 64
-        rw = rw - rw % 64    
-        resized_frame = torchvision.transforms.functional.resize(frame, size=(rh, rw), antialias=True)
-        resized_frame = resized_frame[None]/255.0
-        matting_results = self.mat_model(resized_frame.to(self.device))
-        alpha = matting_results['alpha_os8']
-        alpha = torchvision.transforms.functional.resize(alpha, size=(h, w), antialias=True)[0, 0]
-        frame[:, alpha < thresh] = torch.tensor(background).to(torch.uint8)[:, None]
-        return frame
+        rw = rw - rw % 64
+        return rh, rw
+
+    @torch.no_grad()
+    def matting(self, frame, thresh=0.3, background=[255, 255, 255]):
+        return self.matting_batch([frame], thresh=thresh, background=background)[0]
+
+    @torch.no_grad()
+    def matting_batch(self, frames, thresh=0.3, background=[255, 255, 255]):
+        # frames: list of [3, H, W] uint8 frames with the same resolution
+        frames = torch.stack(frames, dim=0)
+        h, w = frames.shape[2], frames.shape[3]
+        rh, rw = self._infer_size(h, w)
+        resized_frames = torchvision.transforms.functional.resize(frames, size=(rh, rw), antialias=True)
+        resized_frames = resized_frames.to(self.device)/255.0
+        matting_results = self.mat_model(resized_frames)
+        alphas = matting_results['alpha_os8']
+        alphas = torchvision.transforms.functional.resize(alphas, size=(h, w), antialias=True)[:, 0]
+        masks = (alphas < thresh).to(frames.device)
+        background = torch.tensor(background).to(torch.uint8)[:, None]
+        for frame, mask in zip(frames, masks):
+            frame[:, mask] = background
+        return list(frames.unbind(dim=0))
 
 
 def move_to(obj, dtype, device):
@@ -207,3 +410,87 @@ def move_to(obj, dtype, device):
     else:
         print(obj, type(obj))
         raise TypeError("Invalid type for move_to")
+
+
+def batch_iter(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch):
+        yield batch
+
+
+def find_video_segments(video_path, num_segments):
+    # demux only (no decoding): keyframe times and frame times of the video stream
+    import av
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        keyframes, frame_times = [], []
+        for packet in container.demux(stream):
+            if packet.pts is None:
+                continue
+            pts = float(packet.pts * stream.time_base)
+            frame_times.append(pts)
+            if packet.is_keyframe:
+                keyframes.append(pts)
+        fps = float(stream.average_rate)
+    frame_times.sort()
+    keyframes.sort()
+    # split at the keyframes closest to equal frame counts, the first segment also
+    # takes the frames before the first keyframe
+    boundaries = [float('-inf')]
+    for seg_idx in range(1, num_segments):
+        target = frame_times[len(frame_times) * seg_idx // num_segments]
+        keyframe = min(keyframes, key=lambda k: abs(k - target))
+        if keyframe > keyframes[0] and keyframe > boundaries[-1]:
+            boundaries.append(keyframe)
+    boundaries.append(float('inf'))
+    eps = 0.5 / fps
+    segments, offset = [], 0
+    for seg_idx in range(len(boundaries) - 1):
+        start, end = boundaries[seg_idx], boundaries[seg_idx + 1]
+        num_frames = len([t for t in frame_times if start - eps <= t < end - eps])
+        # start decoding one keyframe earlier, open-GOP frames may reference it
+        seek_time = max([k for k in keyframes if k < start - eps], default=0.0)
+        segments.append({
+            'start': start - eps, 'end': end - eps, 'seek': seek_time,
+            'frame_offset': offset, 'num_frames': num_frames
+        })
+        offset += num_frames
+    return segments
+
+
+def ingest_segment(video_path, segment, matting_thresh, matting_batch, num_threads, encode_workers, device, results):
+    encode_pool = ThreadPoolExecutor(max_workers=encode_workers)
+    try:
+        torch.set_num_threads(num_threads)
+        matting_engine = RobustMattingEngine(device=device)
+        video = torchvision.io.VideoReader(video_path, 'video')
+        video.seek(segment['seek'])
+        segment_frames = (
+            frame['data'] for frame in video if segment['start'] <= frame['pts'] < segment['end']
+        )
+        segment_frames = itertools.islice(segment_frames, segment['num_frames'])
+        matted_frames = (
+            frame for frame_batch in batch_iter(segment_frames, matting_batch)
+            for frame in matting_engine.matting_batch(frame_batch, thresh=matting_thresh)
+        )
+        # encoded in the pool, put in frame order
+        visulization, pending = {}, collections.deque()
+        def put_encoded(f_idx, future):
+            results.put(('f_{:07d}.jpg'.format(f_idx), future.result(), f_idx, visulization.pop(f_idx, None)))
+        for idx, frame in enumerate(matted_frames):
+            f_idx = segment['frame_offset'] + idx
+            pending.append((f_idx, encode_pool.submit(DataEngine._encode_frame, frame, f_idx, visulization)))
+            if len(pending) > encode_workers:
+                put_encoded(*pending.popleft())
+        while len(pending):
+            put_encoded(*pending.popleft())
+    except BaseException as e:
+        results.put(e)
+    finally:
+        encode_pool.shutdown(wait=True)
+    results.put(None)
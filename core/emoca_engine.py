@@ -7,9 +7,13 @@ import face_alignment
 from model.EMOCA import EMOCA
 
 class Emoca_Engine:
-    def __init__(self, emoca_ckpt_path, device='cuda', lazy_init=True):
+    def __init__(self, emoca_ckpt_path, device='cuda', lazy_init=True, track_face_box=False):
         self._emoca_ckpt_path = emoca_ckpt_path
         self._device = device
+        # reuse the face box of the previous frames instead of running the face detector every frame
+        self._track_face_box = track_face_box
+        self._min_lmks_score = 0.5
+        self._min_box_iou = 0.6
         if not lazy_init:
             self._init_model()
 
@@ -36,21 +40,24 @@ class Emoca_Engine:
         print('Done.')
 
     @staticmethod
-    def _crop_frame(frame, landmark):
-        min_xy = landmark.min(dim=0)[0]
-        max_xy = landmark.max(dim=0)[0]
-        box = torch.tensor([min_xy[0], min_xy[1], max_xy[0], max_xy[1]])
-        size = int((box[2]+box[3]-box[0]-box[1])/2*1.375)
-        center = torch.tensor([(box[0]+box[2])/2.0, (box[1]+box[3])/2.0, size])
-        frame = torchvision.transforms.functional.crop(
-            frame.float(), 
-            top=int(center[1]-size/2), left=int(center[0]-size/2),
-            height=size, width=size,
+    def _crop_frames(frames, landmarks, crop_size=224):
+        # square crops around the landmarks resized to crop_size, one roi_align over all frames
+        min_xy = landmarks.min(dim=1)[0]
+        max_xy = landmarks.max(dim=1)[0]
+        size = ((max_xy - min_xy).sum(dim=-1) / 2 * 1.375).trunc().float()
+        center_xy = ((min_xy + max_xy) / 2.0).float()
+        top_left = (center_xy - size[:, None] / 2).trunc()
+        boxes = torch.cat([
+            torch.arange(frames.shape[0], device=frames.device).float()[:, None],
+            top_left.to(frames.device), (top_left + size[:, None]).to(frames.device)
+        ], dim=-1)
+        croped_frames = torchvision.ops.roi_align(
+            frames.float(), boxes, output_size=crop_size, spatial_scale=1.0, sampling_ratio=-1, aligned=True
         )
-        frame = torchvision.transforms.functional.resize(frame, size=224, antialias=True)
-        return frame, center
+        centers = torch.cat([center_xy, size[:, None]], dim=-1)
+        return croped_frames, centers
 
-    def process_face(self, image):
+    def _detect_lmks(self, image):
         if not hasattr(self, 'emoca_model'):
             self._init_model()
         # face alignment
@@ -63,8 +70,16 @@ class Emoca_Engine:
         else:
             lmks = torch.tensor(lmks[0]).half()
             self.last_lmks = lmks
+            # reference for box tracking: detector box and the landmark box inside it
+            self._ref_face_box = torch.tensor(detected_faces[0][:4]).float()
+            self._ref_lmks_box = _lmks_box(lmks.float())
+        return lmks
+
+    def _detect_lmks_dense(self, image):
+        if not hasattr(self, 'emoca_model'):
+            self._init_model()
         # mediapipe
-        lmk_image = lmk_image.to(torch.uint8).cpu().numpy()
+        lmk_image = image.permute(1, 2, 0).to(torch.uint8).cpu().numpy()
         lmks_dense = self.lmks_dense_model.process(lmk_image)
         if lmks_dense.multi_face_landmarks is None:
             lmks_dense = self.last_lmks_dense
@@ -75,23 +90,112 @@ class Emoca_Engine:
             lmks_dense[:, 1] = lmks_dense[:, 1] * lmk_image.shape[0]
             lmks_dense = torch.tensor(lmks_dense).half()
             self.last_lmks_dense = lmks_dense
-            
-        croped_frame, crop_center = self._crop_frame(image, lmks_dense)
-        torchvision.utils.save_image(croped_frame/255.0, 'debug.jpg')
+        return lmks_dense
+
+    def _seed_box(self, ):
+        # the last detector box moved and scaled with the last tracked landmarks
+        seed_lmks_box = _lmks_box(self.last_lmks.float())
+        ref_size = (self._ref_lmks_box[2:] - self._ref_lmks_box[:2]).clamp(min=1.0)
+        scale = (seed_lmks_box[2:] - seed_lmks_box[:2]) / ref_size
+        seed_box = (self._ref_face_box.view(2, 2) - self._ref_lmks_box[:2]) * scale + seed_lmks_box[:2]
+        return seed_box.view(4)
+
+    def _tracked(self, lmks, score):
+        # confident, and close to the landmarks of the previous frame
+        iou = _box_iou(_lmks_box(lmks), _lmks_box(self.last_lmks.float()))
+        return score >= self._min_lmks_score and iou >= self._min_box_iou
+
+    def _track_lmks(self, images):
+        # one FAN pass over the frames seeded from the last tracked frame; a frame failing the check
+        # is re-run seeded from its previous frame, and only goes to full detection if that fails too
+        results, batch_lmks, batch_start = [], None, 0
+        for idx, image in enumerate(images):
+            if not hasattr(self, '_ref_face_box'):
+                results.append(self._detect_lmks(image))
+                continue
+            if batch_lmks is None:
+                batch_seed = self.last_lmks
+                batch_lmks, batch_scores = self._fan_landmarks(images[idx:], self._seed_box())
+                batch_start = idx
+            lmks, score = batch_lmks[idx - batch_start], batch_scores[idx - batch_start]
+            if not self._tracked(lmks, score) and self.last_lmks is not batch_seed:
+                lmks, scores = self._fan_landmarks(image[None], self._seed_box())
+                lmks, score = lmks[0], scores[0]
+            if self._tracked(lmks, score):
+                results.append(lmks.half())
+                self.last_lmks = results[-1]
+            else:
+                # lost or drifted: full detection and a new reference box
+                results.append(self._detect_lmks(image))
+        return results
+
+    @torch.no_grad()
+    def _fan_landmarks(self, images, face_box):
+        from face_alignment.utils import crop, get_preds_fromhm
+        d = face_box.tolist()
+        center = torch.tensor([d[2] - (d[2] - d[0]) / 2.0, d[3] - (d[3] - d[1]) / 2.0])
+        center[1] = center[1] - (d[3] - d[1]) * 0.12
+        scale = (d[2] - d[0] + d[3] - d[1]) / self.lmks_model.face_detector.reference_scale
+        inputs = []
+        for image in images:
+            inp = crop(image.permute(1, 2, 0).cpu().numpy(), center, scale)
+            inputs.append(torch.from_numpy(inp.transpose((2, 0, 1))).float())
+        inputs = torch.stack(inputs, dim=0).to(self._device) / 255.0
+        heatmaps = self.lmks_model.face_alignment_net(inputs).detach()
+        heatmaps = heatmaps.to(device='cpu', dtype=torch.float32).numpy()
+        lmks, scores = [], []
+        for idx in range(images.shape[0]):
+            _, pts_img, score = get_preds_fromhm(heatmaps[idx:idx+1], center.numpy(), scale)
+            lmks.append(torch.from_numpy(pts_img).view(68, 2).float())
+            scores.append(float(score.mean()))
+        return lmks, scores
+
+    def encode_faces(self, images, lmks, lmks_dense):
+        # images: [N, 3, H, W] unnormed, lmks / lmks_dense: [N, 68, 2] / [N, 478, 2]
+        if not hasattr(self, 'emoca_model'):
+            self._init_model()
+        croped_frames, crop_centers = self._crop_frames(images, lmks_dense)
         # please input normed image
-        croped_frame = croped_frame.to(self._device)[None]/255.0
-        emoca_result = self.emoca_model.encode(croped_frame)
-        bbox = torch.stack([
-            crop_center[0] - crop_center[2]/2, crop_center[1] - crop_center[2]/2,
-            crop_center[0] + crop_center[2]/2, crop_center[1] + crop_center[2]/2,
-        ])
-        bbox[[0, 2]] /= image.shape[-1]
-        bbox[[1, 3]] /= image.shape[-2]
-        results = {
-            'shape': emoca_result['shape'], 
-            'exp': emoca_result['exp'], 
-            'pose': emoca_result['pose'],
-            'lmks': lmks, 'lmks_dense': lmks_dense,
-            'face_box': bbox.cpu().half(), 
-        }
+        croped_frames = croped_frames.to(self._device)/255.0
+        emoca_result = self.emoca_model.encode(croped_frames)
+        crop_centers = crop_centers.cpu()
+        bboxes = torch.stack([
+            crop_centers[:, 0] - crop_centers[:, 2]/2, crop_centers[:, 1] - crop_centers[:, 2]/2,
+            crop_centers[:, 0] + crop_centers[:, 2]/2, crop_centers[:, 1] + crop_centers[:, 2]/2,
+        ], dim=-1)
+        bboxes[:, [0, 2]] /= images.shape[-1]
+        bboxes[:, [1, 3]] /= images.shape[-2]
+        # clone the per-frame slices, torch.save would store the whole batch for every view
+        results = []
+        for idx in range(images.shape[0]):
+            results.append({
+                'shape': emoca_result['shape'][idx].clone(), 
+                'exp': emoca_result['exp'][idx].clone(), 
+                'pose': emoca_result['pose'][idx].clone(),
+                'lmks': lmks[idx].clone(), 'lmks_dense': lmks_dense[idx].clone(),
+                'face_box': bboxes[idx].half(), 
+            })
         return results
+
+    def process_faces(self, images):
+        # landmarks are tracked frame by frame, the EMOCA encoders run on the whole batch
+        if self._track_face_box:
+            lmks = self._track_lmks(images)
+        else:
+            lmks = [self._detect_lmks(image) for image in images]
+        lmks_dense = [self._detect_lmks_dense(image) for image in images]
+        return self.encode_faces(images, torch.stack(lmks), torch.stack(lmks_dense))
+
+    def process_face(self, image):
+        return self.process_faces(image[None])[0]
+
+
+def _lmks_box(lmks):
+    return torch.cat([lmks.min(dim=0)[0], lmks.max(dim=0)[0]])
+
+
+def _box_iou(box_a, box_b):
+    # degenerate or non-finite boxes give 0, which sends the tracker back to the detector
+    inter = (torch.min(box_a[2:], box_b[2:]) - torch.max(box_a[:2], box_b[:2])).clamp(min=0).prod()
+    union = (box_a[2:] - box_a[:2]).clamp(min=0).prod() + (box_b[2:] - box_b[:2]).clamp(min=0).prod() - inter
+    return float(torch.nan_to_num(inter / union.clamp(min=1e-6), nan=0.0, posinf=0.0))
@@ -0,0 +1,105 @@
+import torch
+from pytorch3d.transforms import rotation_6d_to_matrix
+
+from .pose_solver import reprojection_cost
+
+# Fused inner step of the landmark fitting loops (lightning, camera calibration): both landmark sets are
+# projected at once with the analytic camera of utils/projection, and Adam updates all params with one
+# foreach update. Both parts are compiled with torch.compile when possible and run eagerly otherwise.
+
+def landmark_objective(pred_lmk_68, pred_lmk_dense, gt_lmk_68, gt_lmk_dense, image_size, scale=65):
+    # one weighted point set, the per-point weights reproduce scale * (lmk_loss(68) + lmk_loss(dense))
+    num_68, num_dense = pred_lmk_68.shape[1], pred_lmk_dense.shape[1]
+    weights = torch.cat([
+        pred_lmk_68.new_full((num_68, ), scale / (image_size * 2 * num_68)),
+        pred_lmk_68.new_full((num_dense, ), scale / (image_size * 2 * num_dense)),
+    ])
+    points = torch.cat([pred_lmk_68, pred_lmk_dense], dim=1).detach()
+    target = torch.cat([gt_lmk_68, gt_lmk_dense], dim=1)
+    return points, target, weights
+
+
+def landmark_loss(points, target, weights, rotation_6d, translation, focal_length, principal_point, image_size):
+    # per-sample loss [B], one rotation matrix and one projection for both landmark sets
+    rotation = rotation_6d_to_matrix(rotation_6d)
+    cost = reprojection_cost(
+        points, target, weights, rotation, translation, focal_length, principal_point, image_size
+    )
+    return cost / points.shape[0]
+
+
+def _adam_update(params, grads, exp_avgs, exp_avg_sqs, step, lr, beta1, beta2, eps):
+    # step: 0-dim tensor, so the compiled graph is reused across steps
+    with torch.no_grad():
+        step += 1
+        bias_correction1 = 1 - beta1 ** step
+        bias_correction2_sqrt = (1 - beta2 ** step).sqrt()
+        torch._foreach_lerp_(exp_avgs, grads, 1 - beta1)
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+        torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+        denom = torch._foreach_sqrt(exp_avg_sqs)
+        torch._foreach_div_(denom, bias_correction2_sqrt)
+        torch._foreach_add_(denom, eps)
+        updates = torch._foreach_div(exp_avgs, denom)
+        torch._foreach_mul_(updates, lr / bias_correction1)
+        torch._foreach_sub_(params, updates)
+
+
+class CompiledStep:
+    """
+    torch.compile(fn) with an eager fallback when torch.compile is missing or fails.
+    fn should be a module-level function: compiled graphs are cached on its code object and
+    reused by every CompiledStep of it.
+    """
+    def __init__(self, fn, enabled=True):
+        self._fn = fn
+        self._compiled = None
+        if enabled:
+            if hasattr(torch, 'compile'):
+                self._compiled = torch.compile(fn)
+            else:
+                print('torch.compile is not available, {} runs eagerly.'.format(fn.__name__))
+
+    @property
+    def compiled(self, ):
+        return self._compiled is not None
+
+    def __call__(self, *args, **kwargs):
+        if self._compiled is not None:
+            try:
+                return self._compiled(*args, **kwargs)
+            except Exception as e:
+                print('Compiling {} failed, falling back to eager: {}'.format(self._fn.__name__, e))
+                self._compiled = None
+        return self._fn(*args, **kwargs)
+
+
+class FusedAdam(torch.optim.Optimizer):
+    # Adam without weight decay / amsgrad, every param group is updated by one (compiled) foreach update
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, compile=True):
+        super().__init__(params, dict(lr=lr, betas=betas, eps=eps))
+        self._update = CompiledStep(_adam_update, enabled=compile)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            params = [p for p in group['params'] if p.grad is not None]
+            if not len(params):
+                continue
+            for p in params:
+                if not len(self.state[p]):
+                    self.state[p]['exp_avg'] = torch.zeros_like(p)
+                    self.state[p]['exp_avg_sq'] = torch.zeros_like(p)
+            if 'step' not in group:
+                group['step'] = torch.zeros((), device=params[0].device)
+            beta1, beta2 = group['betas']
+            self._update(
+                params, [p.grad for p in params],
+                [self.state[p]['exp_avg'] for p in params], [self.state[p]['exp_avg_sq'] for p in params],
+                group['step'], group['lr'], beta1, beta2, group['eps']
+            )
+        return loss
@@ -1,15 +1,34 @@
 import os
 import math
 import torch
-from pytorch3d.renderer import PerspectiveCameras
 from pytorch3d.transforms import euler_angles_to_matrix, matrix_to_rotation_6d, rotation_6d_to_matrix
 
 from model.FLAME.FLAME import FLAME_MP
+from utils.projection import project_points
+from .pose_solver import solve_pose, reprojection_cost
+from .optim_loop import run_optimization
+from .fused_step import landmark_objective, landmark_loss, CompiledStep, FusedAdam
 
 class Lightning_Engine:
-    def __init__(self, flame_model_path, device='cuda', lazy_init=True):
+    def __init__(
+            self, flame_model_path, device='cuda', lazy_init=True, solver='adam', lm_iters=10,
+            warm_start=False, converge_tol=0.0, grad_tol=0.0, compile_step=False
+        ):
+        assert solver in ['adam', 'lm'], solver
         self._device = device
         self._flame_model_path = flame_model_path
+        self._solver = solver
+        self._lm_iters = lm_iters
+        self._warm_start = warm_start
+        self._converge_tol = converge_tol
+        self._grad_tol = grad_tol
+        self._compile_step = compile_step
+        self._warm_state = None
+        self.step_log = []
+
+    def reset_warm_start(self, ):
+        # call before a new frame sequence
+        self._warm_state = None
 
     def init_model(self, camera_params, image_size=512):
         print('Initializing lightning models...')
@@ -20,19 +39,17 @@ class Lightning_Engine:
         self.principal_point = camera_params['principal_point'].to(self._device)
         # build flame
         self.flame_model = FLAME_MP(self._flame_model_path, 100, 50).to(self._device)
+        if self._compile_step:
+            self._landmark_loss = CompiledStep(landmark_loss)
         print('Done.')
 
-    def _build_cameras_kwargs(self, batch_size):
-        screen_size = torch.tensor(
-            [self.image_size, self.image_size], device=self._device
-        ).float()[None].repeat(batch_size, 1)
-        cameras_kwargs = {
-            'principal_point': self.principal_point.repeat(batch_size, 1), 'focal_length': self.focal_length, 
-            'image_size': screen_size, 'device': self._device,
-        }
-        return cameras_kwargs
+    def _project(self, points, rotation, translation):
+        screen_points, _ = project_points(
+            points, rotation, translation, self.focal_length, self.principal_point, self.image_size
+        )
+        return screen_points
 
-    def flame_to_camera(self, cameras, flame_pose, pred_lmks, gt_lmks):
+    def flame_to_camera(self, flame_pose, pred_lmks, gt_lmks):
         # rotation
         flame_pose[:, 1] += math.pi
         flame_pose[:, 0] *= -1
@@ -40,8 +57,7 @@ class Lightning_Engine:
         # translation
         translation = rotation_matrix.new_zeros(rotation_matrix.shape[0], 3)
         translation[..., 2] = self.focal_length
-        cameras.get_camera_center(R=rotation_matrix, T=translation)
-        pred_lmks = cameras.transform_points_screen(pred_lmks)
+        pred_lmks = self._project(pred_lmks, rotation_matrix, translation)
         translation[..., :2] = (pred_lmks.mean(dim=1)[..., :2] - gt_lmks.mean(dim=1)[..., :2]) * 2 / self.image_size
         return rotation_matrix, translation
 
@@ -51,39 +67,41 @@ class Lightning_Engine:
         flame_pose = batch_data['emoca']['pose'].clone()
         batch_data['emoca']['pose'][..., :3] *= 0
         batch_data['frames'] = batch_data['frames'] / 255.0
-        cameras_kwargs = self._build_cameras_kwargs(batch_size)
         # flame params
-        flame_verts, pred_lmk_68, pred_lmk_dense = self.flame_model(
-            shape_params=batch_data['shape_code'][None].expand(batch_size, -1), 
+        self.flame_model.bind_identity(batch_data['shape_code'])
+        pred_lmk_68, pred_lmk_dense = self.flame_model.forward_landmarks(
+            shape_params=None,
             expression_params=batch_data['emoca']['exp'],
             pose_params=batch_data['emoca']['pose']
         )
-        flame_verts = flame_verts * self.flame_scale
         pred_lmk_68, pred_lmk_dense = pred_lmk_68 * self.flame_scale, pred_lmk_dense * self.flame_scale
         # build params
-        cameras = PerspectiveCameras(**cameras_kwargs)
         rotation, translation = self.flame_to_camera(
-            cameras, flame_pose, pred_lmk_68, batch_data['emoca']['lmks']
+            flame_pose, pred_lmk_68, batch_data['emoca']['lmks']
         )
-        translation = torch.nn.Parameter(translation)
-        rotation = torch.nn.Parameter(matrix_to_rotation_6d(rotation))
-        params = [{'params': [rotation, translation], 'lr': 0.02}]
-        optimizer = torch.optim.Adam(params)
-        scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=steps, gamma=0.1)
-        # run
-        for idx in range(steps):
-            points_68 = cameras.transform_points_screen(pred_lmk_68, R=rotation_6d_to_matrix(rotation), T=translation)[..., :2]
-            points_dense = cameras.transform_points_screen(pred_lmk_dense, R=rotation_6d_to_matrix(rotation), T=translation)[..., :2]
-            loss_lmk_68 = lmk_loss(points_68, batch_data['emoca']['lmks'], self.image_size)
-            loss_lmk_dense = lmk_loss(points_dense, batch_data['emoca']['lmks_dense'][:, self.flame_model.mediapipe_idx], self.image_size)
-            all_loss = (loss_lmk_68 + loss_lmk_dense) * 65
-            optimizer.zero_grad()
-            all_loss.backward()
-            optimizer.step()
-            scheduler.step()
+        heuristic_pose = (rotation, translation)
+        if self._warm_start and self._warm_state is not None:
+            rotation, translation = self.warm_start_transform(
+                batch_data, pred_lmk_68, pred_lmk_dense, rotation, translation
+            )
+        if self._solver == 'lm':
+            rotation, translation = self.solve_transform(
+                batch_data, pred_lmk_68, pred_lmk_dense, init_poses=[(rotation, translation)]
+            )
+        else:
+            adam_transform = self.fused_transform if self._compile_step else self.adam_transform
+            rotation, translation = adam_transform(
+                batch_data, pred_lmk_68, pred_lmk_dense, rotation, translation, steps,
+                tol=self._converge_tol, grad_tol=self._grad_tol
+            )
+        if self._warm_start:
+            # heuristic and optimized pose of the last frame, seeds the next minibatch
+            self._warm_state = (
+                heuristic_pose[0][-1].detach(), heuristic_pose[1][-1].detach(), rotation[-1].detach(), translation[-1].detach()
+            )
         # gather results
         lightning_results = {}
-        transform_matrix = torch.cat([rotation_6d_to_matrix(rotation), translation[:, :, None]], dim=-1)
+        transform_matrix = torch.cat([rotation, translation[:, :, None]], dim=-1)
         for idx, name in enumerate(batch_data['frame_names']):
             lightning_results[name] = {
                 'flame_pose': batch_data['emoca']['pose'][idx].half().cpu(),
@@ -93,11 +111,93 @@ class Lightning_Engine:
             }
         return lightning_results
 
+    def warm_start_transform(self, batch_data, pred_lmk_68, pred_lmk_dense, rotation, translation):
+        # carry the correction optimized for the previous frame (heuristic -> optimized view space)
+        # over to the heuristic pose of every frame: X R_h Rc + T_h Rc + Tc
+        prev_rotation, prev_translation, opt_rotation, opt_translation = self._warm_state
+        correct_rotation = prev_rotation.T @ opt_rotation
+        correct_translation = opt_translation - prev_translation @ correct_rotation
+        warm_rotation = rotation @ correct_rotation
+        warm_translation = translation @ correct_rotation + correct_translation
+        # keep the heuristic where it fits better, e.g. after a cut
+        points, target, weights = self._lmk_objective(batch_data, pred_lmk_68, pred_lmk_dense)
+        costs = [
+            reprojection_cost(points, target, weights, R, T, self.focal_length, self.principal_point, self.image_size)
+            for R, T in [(rotation, translation), (warm_rotation, warm_translation)]
+        ]
+        use_warm = costs[1] < costs[0]
+        rotation = torch.where(use_warm[:, None, None], warm_rotation, rotation)
+        translation = torch.where(use_warm[:, None], warm_translation, translation)
+        return rotation, translation
+
+    def adam_transform(
+            self, batch_data, pred_lmk_68, pred_lmk_dense, rotation, translation, steps, tol=0.0, grad_tol=0.0
+        ):
+        translation = torch.nn.Parameter(translation)
+        rotation = torch.nn.Parameter(matrix_to_rotation_6d(rotation))
+        params = [{'params': [rotation, translation], 'lr': 0.02}]
+        optimizer = torch.optim.Adam(params)
+        scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=steps, gamma=0.1)
+        # run
+        def closure():
+            rotation_matrix = rotation_6d_to_matrix(rotation)
+            points_68 = self._project(pred_lmk_68, rotation_matrix, translation)
+            points_dense = self._project(pred_lmk_dense, rotation_matrix, translation)
+            loss_lmk_68 = lmk_loss(points_68, batch_data['emoca']['lmks'], self.image_size, per_sample=True)
+            loss_lmk_dense = lmk_loss(points_dense, batch_data['emoca']['lmks_dense'][:, self.flame_model.mediapipe_idx], self.image_size, per_sample=True)
+            return (loss_lmk_68 + loss_lmk_dense) * 65
+        _, sample_steps = run_optimization(
+            closure, optimizer, steps, scheduler=scheduler, rel_tol=tol, grad_tol=grad_tol,
+            sample_params=[rotation, translation]
+        )
+        self.step_log.append(sample_steps)
+        return rotation_6d_to_matrix(rotation).detach(), translation.detach()
+
+    def fused_transform(
+            self, batch_data, pred_lmk_68, pred_lmk_dense, rotation, translation, steps, tol=0.0, grad_tol=0.0
+        ):
+        # adam_transform with one analytic projection of both landmark sets and a fused adam update,
+        # both compiled when possible
+        points, target, weights = self._lmk_objective(batch_data, pred_lmk_68, pred_lmk_dense)
+        translation = torch.nn.Parameter(translation)
+        rotation = torch.nn.Parameter(matrix_to_rotation_6d(rotation))
+        optimizer = FusedAdam([rotation, translation], lr=0.02, compile=self._landmark_loss.compiled)
+        scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=steps, gamma=0.1)
+        def closure():
+            return self._landmark_loss(
+                points, target, weights, rotation, translation, self.focal_length, self.principal_point, self.image_size
+            )
+        _, sample_steps = run_optimization(
+            closure, optimizer, steps, scheduler=scheduler, rel_tol=tol, grad_tol=grad_tol,
+            sample_params=[rotation, translation]
+        )
+        self.step_log.append(sample_steps)
+        return rotation_6d_to_matrix(rotation).detach(), translation.detach()
+
+    def _lmk_objective(self, batch_data, pred_lmk_68, pred_lmk_dense):
+        # same objective as adam_transform, per-point weights reproduce the two lmk_loss means
+        return landmark_objective(
+            pred_lmk_68, pred_lmk_dense, batch_data['emoca']['lmks'],
+            batch_data['emoca']['lmks_dense'][:, self.flame_model.mediapipe_idx], self.image_size
+        )
+
+    def solve_transform(self, batch_data, pred_lmk_68, pred_lmk_dense, init_poses=[]):
+        points, target, weights = self._lmk_objective(batch_data, pred_lmk_68, pred_lmk_dense)
+        rotation, translation, _ = solve_pose(
+            points, target, weights, self.focal_length, self.principal_point, self.image_size,
+            init_poses=init_poses, iterations=self._lm_iters
+        )
+        return rotation, translation
+
 
-def lmk_loss(opt_lmks, target_lmks, image_size, lmk_mask=None):
+def lmk_loss(opt_lmks, target_lmks, image_size, lmk_mask=None, per_sample=False):
     size = torch.tensor([1 / image_size, 1 / image_size], device=opt_lmks.device).float()[None, None, ...]
     diff = torch.pow(opt_lmks - target_lmks, 2)
     if lmk_mask is None:
-        return (diff * size).mean()
+        loss = diff * size
     else:
-        return (diff * size * lmk_mask).mean()
+        loss = diff * size * lmk_mask
+    if per_sample:
+        # share of every sample in the mean
+        return loss.flatten(1).sum(dim=1) / loss.numel()
+    return loss.mean()
@@ -0,0 +1,92 @@
+import torch
+from tqdm.rich import tqdm
+
+def run_optimization(
+        closure, optimizer, steps, scheduler=None, rel_tol=0.0, grad_tol=0.0, check_every=10, patience=2,
+        sample_params=[], desc=None, miniters=1
+    ):
+    """
+    Shared inner loop of the fitting stages: loss, backward, optimizer and scheduler step, at most steps times.
+    closure() returns a scalar loss, or the loss of every sample [B] (their sum is minimized) when
+    sample_params (tensors with the sample on dim 0) are given.
+    It stops once the best loss improved by less than rel_tol (relative) in patience windows of check_every
+    steps in a row, or once the gradient norm drops below grad_tol. With per-sample losses both criteria
+    apply per sample: converged samples keep their parameters from then on and the loop stops when all of
+    them converged.
+    Returns the last loss and the number of steps every sample used ([B], or [1] for a scalar loss).
+    """
+    steps_iter = range(steps)
+    if desc is not None:
+        steps_iter = tqdm(steps_iter, desc='', leave=True, miniters=miniters, ncols=120, colour='#95bb72')
+    converged, frozen, sample_steps = None, None, None
+    best_loss, check_loss = None, None
+    for idx in steps_iter:
+        loss = closure()
+        if converged is None:
+            converged = torch.zeros(loss.numel(), dtype=torch.bool, device=loss.device)
+            sample_steps = torch.full((loss.numel(), ), steps, dtype=torch.long)
+            frozen = [p.detach().clone() for p in sample_params]
+        optimizer.zero_grad()
+        loss.sum().backward()
+        # convergence of the current parameters, before they are updated
+        newly = torch.zeros_like(converged)
+        if rel_tol > 0:
+            # best loss so far, robust to the oscillation of adam
+            best_loss = loss.detach().view(-1) if best_loss is None else torch.minimum(best_loss, loss.detach().view(-1))
+            if idx % check_every == 0:
+                if check_loss is not None:
+                    stalled = check_loss - best_loss < rel_tol * check_loss.abs()
+                    stall_checks = torch.where(stalled, stall_checks + 1, torch.zeros_like(stall_checks))
+                    newly |= stall_checks >= patience
+                else:
+                    stall_checks = torch.zeros_like(best_loss, dtype=torch.long)
+                check_loss = best_loss
+        if grad_tol > 0:
+            if len(sample_params):
+                newly |= _grad_norm(sample_params, per_sample=True) < grad_tol
+            else:
+                newly |= _grad_norm(_optimizer_params(optimizer), per_sample=False) < grad_tol
+        newly &= ~converged
+        if newly.any():
+            sample_steps[newly.cpu()] = idx
+            for p, f in zip(sample_params, frozen):
+                f[newly] = p.detach()[newly]
+            converged |= newly
+        if converged.all():
+            break
+        optimizer.step()
+        if scheduler is not None:
+            scheduler.step()
+        if converged.any():
+            with torch.no_grad():
+                for p, f in zip(sample_params, frozen):
+                    p[converged] = f[converged]
+        if desc is not None:
+            steps_iter.set_description(f'Loss({desc}): {loss.sum().item():.4f}')
+    return loss.detach(), sample_steps
+
+
+def _optimizer_params(optimizer):
+    return [p for group in optimizer.param_groups for p in group['params'] if p.requires_grad]
+
+
+def _grad_norm(params, per_sample):
+    # per sample: norm over each row (dim 0) of all params, otherwise one global norm
+    squares = []
+    for p in params:
+        if p.grad is None:
+            continue
+        grad = p.grad.detach()
+        squares.append(grad.flatten(1).pow(2).sum(dim=1) if per_sample else grad.pow(2).sum().view(1))
+    return torch.stack(squares).sum(dim=0).sqrt()
+
+
+def step_summary(name, sample_steps_log):
+    # sample_steps_log: the per-sample step counts returned by run_optimization, one entry per call
+    if not len(sample_steps_log):
+        return
+    loop_steps = torch.tensor([s.max().item() for s in sample_steps_log]).float()
+    all_steps = torch.cat(sample_steps_log).float()
+    print('{}: {:.1f} steps per call (max {}), {:.1f} steps per sample.'.format(
+        name, loop_steps.mean().item(), int(loop_steps.max().item()), all_steps.mean().item()
+    ))
@@ -0,0 +1,118 @@
+import torch
+
+from utils.projection import project_points
+
+# Rigid pose of fixed 3D landmarks under the pytorch3d PerspectiveCameras model (see utils/projection.py),
+# solved as weighted least squares.
+
+def reprojection_cost(points, target, weights, rotation, translation, focal_length, principal_point, image_size):
+    # weights: [N] per point, the cost of each sample is sum_n w_n * |x_n - y_n|^2
+    screen_points, _ = project_points(points, rotation, translation, focal_length, principal_point, image_size)
+    return (((screen_points - target) ** 2).sum(dim=-1) * weights).sum(dim=-1)
+
+
+def procrustes_pose(points, target, weights, focal_length, principal_point, image_size):
+    # scaled orthographic fit in normalized camera coordinates, depth from the scale
+    focal_length = focal_length.reshape(1, 1, -1)
+    principal_point = principal_point.reshape(-1, 1, 2)
+    normed_target = ((1 - 2 * target / image_size) - principal_point) / focal_length
+    weights = (weights / weights.sum())[None, :, None]
+    points_mean = (points * weights).sum(dim=1, keepdim=True)
+    target_mean = (normed_target * weights).sum(dim=1, keepdim=True)
+    points_c, target_c = points - points_mean, normed_target - target_mean
+    # linear map M: [B, 3, 2], target_c ~ points_c @ M
+    gram = (points_c * weights).transpose(1, 2) @ points_c
+    gram = gram + 1e-8 * torch.eye(3, device=points.device, dtype=points.dtype)
+    linear_map = torch.linalg.solve(gram, (points_c * weights).transpose(1, 2) @ target_c)
+    # closest scaled rotation: M = s * [r1, r2]
+    U, S, Vh = torch.linalg.svd(linear_map, full_matrices=False)
+    rotation_xy = U @ Vh
+    scale = S.mean(dim=-1).clamp(min=1e-8)
+    rotation = torch.cat(
+        [rotation_xy, torch.linalg.cross(rotation_xy[..., 0], rotation_xy[..., 1])[..., None]], dim=-1
+    )
+    # the centroid keeps its depth 1/s and projects onto the target centroid
+    depth = 1 / scale
+    rotated_mean = (points_mean @ rotation)[:, 0]
+    translation = torch.cat([
+        target_mean[:, 0] * depth[:, None] - rotated_mean[:, :2], (depth - rotated_mean[:, 2])[:, None]
+    ], dim=-1)
+    return rotation, translation
+
+
+def solve_pose(
+        points, target, weights, focal_length, principal_point, image_size,
+        init_poses=[], iterations=10, damping=1e-3
+    ):
+    """
+    Batched rigid pose: the Procrustes solution (or the best of init_poses) refined with Levenberg-Marquardt.
+    points: [B, N, 3], target: [B, N, 2] screen points, weights: [N].
+    Returns rotation [B, 3, 3], translation [B, 3] and the per-sample cost.
+    """
+    def cost_of(rotation, translation):
+        return reprojection_cost(
+            points, target, weights, rotation, translation, focal_length, principal_point, image_size
+        )
+    rotation, translation = procrustes_pose(points, target, weights, focal_length, principal_point, image_size)
+    cost = cost_of(rotation, translation)
+    for init_rotation, init_translation in init_poses:
+        init_cost = cost_of(init_rotation, init_translation)
+        better = init_cost < cost
+        rotation = torch.where(better[:, None, None], init_rotation, rotation)
+        translation = torch.where(better[:, None], init_translation, translation)
+        cost = torch.where(better, init_cost, cost)
+    focal_xy = focal_length.reshape(1, 1, -1).expand(-1, -1, 2)
+    lambdas = torch.full_like(cost, damping)
+    eye = torch.eye(6, device=points.device, dtype=points.dtype)
+    for _ in range(iterations):
+        screen_points, view_points = project_points(
+            points, rotation, translation, focal_xy, principal_point, image_size
+        )
+        residual = screen_points - target
+        rotated_points = view_points - translation[:, None]
+        # d screen / d view: [B, N, 2, 3]
+        inv_depth = 1 / view_points[..., 2]
+        d_screen = view_points.new_zeros(*view_points.shape[:2], 2, 3)
+        d_screen[..., 0, 0] = inv_depth
+        d_screen[..., 1, 1] = inv_depth
+        d_screen[..., :, 2] = -view_points[..., :2] * inv_depth[..., None] ** 2
+        d_screen = d_screen * (-image_size / 2 * focal_xy)[..., None]
+        # d view / d (rotation increment, translation): X R exp(w) + T ~ q + q x w + T, [B, N, 3, 6]
+        d_view = torch.cat([skew(rotated_points), eye[:3, :3].expand(*rotated_points.shape[:2], 3, 3)], dim=-1)
+        jacobian = (d_screen @ d_view).flatten(1, 2)
+        weighted = jacobian * weights.repeat_interleave(2)[None, :, None]
+        hessian = weighted.transpose(1, 2) @ jacobian
+        gradient = weighted.transpose(1, 2) @ residual.flatten(1, 2)[..., None]
+        damped = hessian + lambdas[:, None, None] * (hessian * eye).clamp(min=1e-9)
+        delta = -torch.linalg.solve(damped, gradient)[..., 0]
+        new_rotation = rotation @ so3_exp(delta[:, :3])
+        new_translation = translation + delta[:, 3:]
+        new_cost = cost_of(new_rotation, new_translation)
+        accept = new_cost < cost
+        rotation = torch.where(accept[:, None, None], new_rotation, rotation)
+        translation = torch.where(accept[:, None], new_translation, translation)
+        cost = torch.where(accept, new_cost, cost)
+        lambdas = torch.where(accept, lambdas * 0.1, lambdas * 10).clamp(1e-7, 1e7)
+    return rotation, translation, cost
+
+
+def skew(vectors):
+    # [..., 3] -> [..., 3, 3], skew(a) @ b = a x b
+    x, y, z = vectors.unbind(-1)
+    zeros = torch.zeros_like(x)
+    return torch.stack([
+        torch.stack([zeros, -z, y], dim=-1),
+        torch.stack([z, zeros, -x], dim=-1),
+        torch.stack([-y, x, zeros], dim=-1),
+    ], dim=-2)
+
+
+def so3_exp(axis_angle):
+    # Rodrigues' formula, [B, 3] -> [B, 3, 3]
+    angle = axis_angle.norm(dim=-1, keepdim=True)[..., None]
+    K = skew(axis_angle)
+    small = angle < 1e-6
+    sin_term = torch.where(small, 1 - angle ** 2 / 6, torch.sin(angle) / angle.clamp(min=1e-6))
+    cos_term = torch.where(small, 0.5 - angle ** 2 / 24, (1 - torch.cos(angle)) / angle.clamp(min=1e-6) ** 2)
+    eye = torch.eye(3, device=axis_angle.device, dtype=axis_angle.dtype)
+    return eye + sin_term * K + cos_term * (K @ K)
@@ -6,13 +6,17 @@ from pytorch3d.renderer import PerspectiveCameras, look_at_view_transform
 from pytorch3d.transforms import matrix_to_rotation_6d, rotation_6d_to_matrix
 
 from model.FLAME.FLAME import FLAME_MP, FLAME_Tex
-from utils.renderer import Mesh_Renderer, Texture_Renderer, Point_Renderer
+from utils.renderer import Mesh_Renderer, Texture_Renderer, Point_Renderer, TextureCache
+from utils.projection import project_points
 
 class Render_Engine(torch.nn.Module):
-    def __init__(self, camera_params, flame_model_path, image_size=512, with_texture=False, device='cuda'):
+    def __init__(
+            self, camera_params, flame_model_path, image_size=512, with_texture=False, device='cuda', texture_cache=None
+        ):
         super(Render_Engine, self).__init__()
 
         self._device = device
+        self.texture_cache = texture_cache if texture_cache is not None else TextureCache()
         self._with_texture = with_texture
         self.image_size = image_size
         self.flame_scale = camera_params['flame_scale']
@@ -55,8 +59,9 @@ class Render_Engine(torch.nn.Module):
             T=batch_data[anno_key]['transform_matrix'][:, :3, 3], 
             **cameras_kwargs
         )
+        self.flame_model.bind_identity(batch_data['shape_code'])
         flame_verts, pred_lmk_68, pred_lmk_dense = self.flame_model(
-            shape_params=batch_data['shape_code'][None].expand(batch_size, -1), 
+            shape_params=None,
             expression_params=batch_data[anno_key]['expression'],
             pose_params=batch_data[anno_key]['flame_pose']
         )
@@ -66,15 +71,20 @@ class Render_Engine(torch.nn.Module):
         # points_image = self.point_render(torch.cat([pred_lmk_68, pred_lmk_dense], dim=1))
         points_image = self.point_render(flame_verts)
         if self._with_texture:
-            if not hasattr(self, 'albedos'):
-                self.albedos = self.flame_texture(batch_data['texture_code'])
-            images, alpha_images, _ = self.mesh_render(flame_verts, self.albedos, cameras)
+            albedos = self.texture_cache.albedo(self.flame_texture, batch_data['texture_code'])
+            images, alpha_images, _ = self.mesh_render(flame_verts, albedos, cameras)
             images = (images * 255.0).clamp(0, 255)
         else:
             images, alpha_images = self.mesh_render(flame_verts, cameras)
         # gather
-        points_68 = cameras.transform_points_screen(pred_lmk_68)[..., :2]
-        points_dense = cameras.transform_points_screen(pred_lmk_dense)[..., :2]
+        rotation = batch_data[anno_key]['transform_matrix'][:, :3, :3]
+        translation = batch_data[anno_key]['transform_matrix'][:, :3, 3]
+        points_68, _ = project_points(
+            pred_lmk_68, rotation, translation, self.focal_length, self.principal_point, self.image_size
+        )
+        points_dense, _ = project_points(
+            pred_lmk_dense, rotation, translation, self.focal_length, self.principal_point, self.image_size
+        )
         vis_images = []
         alpha_images = alpha_images.expand(-1, 3, -1, -1)
         for idx, frame in enumerate(batch_data['frames']):
@@ -0,0 +1,113 @@
+import os
+import sys
+import time
+sys.path.append('./')
+
+import torch
+import torchvision
+from tqdm.rich import tqdm
+
+from .data_engine import RobustMattingEngine, batch_iter, move_to
+from .calibration import optimize_camera
+from .emoca_engine import Emoca_Engine
+from .lightning_engine import Lightning_Engine
+from .core_engine import FLAME_MODEL_PATH, EMOCA_CKPT_PATH
+
+class StreamTrackEngine:
+    """
+    Online tracking: frames are matted, encoded with EMOCA and tracked in fixed-size windows.
+    Only the current window is kept in memory, per-frame results are yielded once the window is done.
+    """
+    def __init__(self, args_config, device='cuda'):
+        self._device = device
+        self._args_config = args_config
+        self.window_size = args_config.stream_window
+        self.output_path = os.path.join('outputs', os.path.splitext(os.path.basename(args_config.data))[0])
+        self.emoca_engine = Emoca_Engine(
+            EMOCA_CKPT_PATH, device=device, lazy_init=True, track_face_box=args_config.track_face_box
+        )
+        self.lightning_engine = Lightning_Engine(
+            FLAME_MODEL_PATH, device=device, lazy_init=True,
+            solver=args_config.lightning_solver, lm_iters=args_config.lm_iters,
+            converge_tol=args_config.converge_tol, grad_tol=args_config.grad_tol, compile_step=args_config.compile_step,
+            # every window starts from its per-frame heuristic plus the correction of the previous frame,
+            # the heuristic alone is kept where it fits better (scene cuts, fast head turns)
+            warm_start=True
+        )
+        self.matting_engine = None
+        if args_config.matting_thresh > 0:
+            self.matting_engine = RobustMattingEngine(device=device)
+
+    @staticmethod
+    def video_frames(video_path):
+        video = torchvision.io.VideoReader(video_path, 'video')
+        for frame in video:
+            yield frame['data']
+
+    def preprocess(self, frames):
+        for frame_batch in batch_iter(frames, self._args_config.matting_batch):
+            if self.matting_engine is not None:
+                frame_batch = self.matting_engine.matting_batch(frame_batch, thresh=self._args_config.matting_thresh)
+            for frame in frame_batch:
+                frame = torchvision.transforms.functional.resize(frame, size=512, antialias=True)
+                frame = torchvision.transforms.functional.center_crop(frame, output_size=512)
+                yield frame
+
+    def track(self, frames):
+        # frames: any iterable of [3, H, W] uint8 frames (video decoder, camera, generator)
+        self.camera_params, shape_sum, num_frames = None, 0, 0
+        self.lightning_engine.reset_warm_start()
+        f_idx = 0
+        for window in batch_iter(self.preprocess(frames), self.window_size):
+            frame_names = ['f_{:07d}.jpg'.format(f_idx + idx) for idx in range(len(window))]
+            f_idx += len(window)
+            window = torch.stack(window, dim=0)
+            emoca_results = self.emoca_engine.process_faces(window.float().to(self._device))
+            emoca_results = torch.utils.data.default_collate(emoca_results)
+            # identity: running mean of the shape codes seen so far
+            shape_sum = shape_sum + emoca_results['shape'].float().sum(dim=0)
+            num_frames += len(window)
+            self.shape_code = (shape_sum / num_frames).half()
+            first_window = self.camera_params is None
+            if first_window:
+                calib_data = move_to(emoca_results, dtype=torch.float32, device='cpu')
+                calib_data = {k: v[:32] for k, v in calib_data.items()}
+                # short calibration, the first results should come within seconds
+                self.camera_params, _ = optimize_camera(
+                    calib_data, window[:32].float(), steps=self._args_config.stream_calib_steps, device=self._device,
+                    rel_tol=self._args_config.converge_tol, grad_tol=self._args_config.grad_tol,
+                    compile_step=self._args_config.compile_step
+                )
+                self.lightning_engine.init_model(self.camera_params, image_size=512)
+            batch_data = {
+                'frame_names': frame_names, 'frames': window,
+                'emoca': emoca_results, 'shape_code': self.shape_code,
+            }
+            batch_data = move_to(batch_data, dtype=torch.float32, device=self._device)
+            # the first window has no warm start yet and gets the full step budget
+            if first_window:
+                lightning_res = self.lightning_engine.lightning_optimize(batch_data)
+            else:
+                lightning_res = self.lightning_engine.lightning_optimize(
+                    batch_data, steps=self._args_config.stream_steps
+                )
+            for idx, frame_name in enumerate(frame_names):
+                lightning_res[frame_name]['lmks'] = emoca_results['lmks'][idx]
+                yield frame_name, lightning_res[frame_name]
+
+    def run(self, frames=None):
+        if frames is None:
+            frames = self.video_frames(self._args_config.data)
+        os.makedirs(self.output_path, exist_ok=True)
+        print('Streaming tracking...')
+        start_time = time.time()
+        stream_results = {}
+        for frame_name, frame_res in tqdm(self.track(frames), ncols=120, colour='#95bb72'):
+            if not len(stream_results):
+                print('First result after {:.1f}s.'.format(time.time() - start_time))
+            stream_results[frame_name] = frame_res
+        stream_results['meta_info'] = self.camera_params
+        stream_results['meta_info']['shape_code'] = self.shape_code
+        torch.save(stream_results, os.path.join(self.output_path, 'stream.pth'))
+        print('Done.')
+        return stream_results
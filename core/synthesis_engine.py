@@ -1,15 +1,30 @@
+import math
 import torch
-from tqdm.rich import tqdm
 from pytorch3d.renderer import PerspectiveCameras, look_at_view_transform
 from pytorch3d.transforms import matrix_to_rotation_6d, rotation_6d_to_matrix
 
-from utils.renderer import Texture_Renderer
+from utils.renderer import Texture_Renderer, TextureCache
+from utils.projection import project_points
+from .optim_loop import run_optimization
 from model.FLAME.FLAME import FLAME_MP, FLAME_Tex
 
 class Synthesis_Engine:
-    def __init__(self, flame_model_path, device='cuda', lazy_init=True):
+    def __init__(
+            self, flame_model_path, device='cuda', lazy_init=True, converge_tol=0.0, grad_tol=0.0, single_pass=False,
+            texture_cache=None, visible_texels=False, pyramid=[], face_roi=False
+        ):
         self._device = device
+        # render a per-frame crop around the head instead of the whole canvas
+        self._face_roi = face_roi
+        # render sizes of the coarse-to-fine schedule, empty: full resolution only
+        self._pyramid = pyramid
+        self._visible_texels = visible_texels
+        self.texture_cache = texture_cache if texture_cache is not None else TextureCache()
+        self._single_pass = single_pass
         self._flame_model_path = flame_model_path
+        self._converge_tol = converge_tol
+        self._grad_tol = grad_tol
+        self.step_log, self.texture_step_log = [], []
 
     def init_model(self, camera_params, image_size=512):
         print('Initializing synthesis models...')
@@ -23,7 +38,8 @@ class Synthesis_Engine:
         self.flame_texture = FLAME_Tex(self._flame_model_path, image_size=512).to(self._device)
         self.flame_face_mask = self.flame_texture.masks.face
         self.mesh_render = Texture_Renderer(
-            512, flame_path=self._flame_model_path, flame_mask=self.flame_face_mask, device=self._device
+            512, flame_path=self._flame_model_path, flame_mask=self.flame_face_mask,
+            single_pass=self._single_pass, device=self._device
         )
         print('Done.')
 
@@ -37,6 +53,45 @@ class Synthesis_Engine:
         }
         return cameras_kwargs
 
+    @torch.no_grad()
+    def head_roi(self, flame_verts, rotation, translation, margin=0.1):
+        # square crop of the canvas around the projected head, one size for the batch (a multiple of 32)
+        # and per-frame origins [B, 2] (x, y) inside the canvas. None when the heads fill the canvas.
+        points, _ = project_points(
+            flame_verts, rotation, translation, self.focal_length, self.principal_point, self.image_size
+        )
+        lows, highs = points.min(dim=1).values, points.max(dim=1).values
+        extent = (highs - lows).max() * (1 + 2 * margin)
+        crop_size = int(math.ceil(extent.item() / 32) * 32)
+        if crop_size >= self.image_size:
+            return None
+        origins = ((lows + highs) / 2 - crop_size / 2).round().long().clamp(0, self.image_size - crop_size)
+        return origins, crop_size
+
+    def _build_roi_cameras_kwargs(self, origins, crop_size):
+        # the canvas camera seen through the crop: screen u' = u - x0 on a crop_size canvas, so
+        # f' = f * S / c and p' = (S * p - S + 2 * x0 + c) / c
+        batch_size, canvas_size = origins.shape[0], self.image_size
+        screen_size = torch.tensor([crop_size, crop_size], device=self._device).float()[None].repeat(batch_size, 1)
+        principal_point = (
+            canvas_size * self.principal_point.reshape(1, 2) - canvas_size + 2 * origins.float() + crop_size
+        ) / crop_size
+        cameras_kwargs = {
+            'principal_point': principal_point, 'focal_length': self.focal_length * canvas_size / crop_size,
+            'image_size': screen_size, 'device': self._device,
+        }
+        return cameras_kwargs
+
+    def pyramid_levels(self, steps):
+        # (render size, steps) coarse to fine, the steps are split evenly and the last level is full size
+        sizes = sorted(set([size for size in self._pyramid if size < self.image_size])) + [self.image_size]
+        level_steps = steps // len(sizes)
+        levels = [
+            (size, level_steps if idx < len(sizes) - 1 else steps - level_steps * (len(sizes) - 1))
+            for idx, size in enumerate(sizes)
+        ]
+        return [(size, size_steps) for size, size_steps in levels if size_steps > 0]
+
     def optimize_texture(self, batch_data, steps=100):
         # ['frame_names', 'frames', 'lightning', 'shape_code']
         batch_size = len(batch_data['frame_names'])
@@ -48,12 +103,22 @@ class Synthesis_Engine:
         rotation, translation = transform_matrix[:, :3, :3], transform_matrix[..., :3, 3]
         cameras = PerspectiveCameras(R=rotation, T=translation, **cameras_kwargs)
         # flame params
+        self.flame_model.bind_identity(batch_data['shape_code'])
         flame_verts, _, _ = self.flame_model(
-            shape_params=batch_data['shape_code'][None].expand(batch_size, -1), 
+            shape_params=None,
             expression_params=batch_data['lightning']['expression'],
             pose_params=batch_data['lightning']['flame_pose']
         )
         flame_verts = flame_verts * self.flame_scale
+        # the geometry is fixed: only the texels sampled for these views are evaluated
+        levels = self.pyramid_levels(steps)
+        texels = None
+        if self._visible_texels:
+            texel_mask = torch.stack([
+                self.mesh_render.sampled_texels(flame_verts, cameras, image_size=size) for size, _ in levels
+            ]).any(dim=0)
+            texels = self.flame_texture.texel_basis(texel_mask)
+            print('Texture optimization on {:.1f}% of the texels.'.format(texel_mask.float().mean().item() * 100))
         # optimize
         texture_params = torch.nn.Parameter(torch.rand(1, 140).to(self._device))
         params = [
@@ -61,20 +126,28 @@ class Synthesis_Engine:
         ]
         optimizer = torch.optim.Adam(params)
         scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=steps, gamma=0.5)
-        tqdm_queue = tqdm(range(steps), desc='', leave=True, miniters=1, ncols=120, colour='#95bb72')
-        for k in tqdm_queue:
-            albedos = self.flame_texture(texture_params)
-            pred_images, masks_all, masks_face = self.mesh_render(flame_verts, albedos, cameras)
-            loss_head = pixel_loss(pred_images, batch_data['frames'], mask=masks_all)
-            loss_face = pixel_loss(pred_images, batch_data['frames'], mask=masks_face)
+        def closure(size, frames):
+            albedos = self.flame_texture(texture_params, texels=texels)
+            pred_images, masks_all, masks_face = self.mesh_render(flame_verts, albedos, cameras, image_size=size)
+            loss_head = pixel_loss(pred_images, frames, mask=masks_all)
+            loss_face = pixel_loss(pred_images, frames, mask=masks_face)
             loss_norm = torch.sum(texture_params ** 2)
             all_loss = (loss_head + loss_face + loss_norm * 2e-5) * 350
             # print(loss_head, loss_face, loss_norm * 0.0001)
-            optimizer.zero_grad()
-            all_loss.backward()
-            optimizer.step()
-            scheduler.step()
-            tqdm_queue.set_description(f'Loss(Texture): {all_loss.item():.4f}')
+            outputs['pred_images'] = pred_images.detach()
+            return all_loss
+        outputs = {}
+        sample_steps = 0
+        for size, level_steps in levels:
+            frames = resize_frames(batch_data['frames'], size)
+            _, level_sample_steps = run_optimization(
+                lambda: closure(size, frames), optimizer, level_steps, scheduler=scheduler,
+                rel_tol=self._converge_tol, grad_tol=self._grad_tol,
+                desc='Texture' if len(levels) == 1 else 'Texture {}'.format(size), miniters=1
+            )
+            sample_steps = sample_steps + level_sample_steps
+        self.texture_step_log.append(sample_steps)
+        pred_images = outputs['pred_images']
         results = {'texture_params': texture_params.detach().cpu()}
         return results, torch.cat([batch_data['frames'][:4], pred_images[:4].clamp(0, 1)]).cpu()
 
@@ -89,7 +162,6 @@ class Synthesis_Engine:
         rotation, translation = transform_matrix[:, :3, :3], transform_matrix[..., :3, 3]
         translation = torch.nn.Parameter(translation)
         rotation = torch.nn.Parameter(matrix_to_rotation_6d(rotation))
-        texture_params = torch.nn.Parameter(batch_data['texture_code'], requires_grad=False)
         expression_codes = torch.nn.Parameter(batch_data['lightning']['expression'])
         params = [
             # {'params': [texture_params], 'lr': 0.005, 'name': ['tex']},
@@ -99,47 +171,77 @@ class Synthesis_Engine:
         ]
         optimizer = torch.optim.Adam(params)
         scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=steps, gamma=0.1)
+        self.flame_model.bind_identity(batch_data['shape_code'])
+        # the texture is frozen, its albedo map is built once per code
+        albedos = self.texture_cache.albedo(self.flame_texture, batch_data['texture_code'])
+        # render and compare the crop around the heads at the lightning pose only
+        frames, roi = batch_data['frames'], None
+        if self._face_roi:
+            with torch.no_grad():
+                flame_verts, _, _ = self.flame_model(
+                    shape_params=None, expression_params=expression_codes,
+                    pose_params=batch_data['lightning']['flame_pose']
+                )
+            roi = self.head_roi(
+                flame_verts * self.flame_scale, transform_matrix[:, :3, :3], transform_matrix[:, :3, 3]
+            )
+        if roi is not None:
+            origins, crop_size = roi
+            cameras_kwargs = self._build_roi_cameras_kwargs(origins, crop_size)
+            frames = torch.stack([
+                frames[idx, :, y:y + crop_size, x:x + crop_size] for idx, (x, y) in enumerate(origins.tolist())
+            ])
         # run        
-        for idx in range(steps):
+        def closure(size, frames):
             # build flame params
             # flame params
             flame_verts, pred_lmk_68, pred_lmk_dense = self.flame_model(
-                shape_params=batch_data['shape_code'][None].expand(batch_size, -1), 
+                shape_params=None,
                 expression_params=expression_codes,
                 pose_params=batch_data['lightning']['flame_pose']
             )
             flame_verts = flame_verts * self.flame_scale
             pred_lmk_68, pred_lmk_dense = pred_lmk_68 * self.flame_scale, pred_lmk_dense * self.flame_scale
 
-            cameras = PerspectiveCameras(
-                R=rotation_6d_to_matrix(rotation), T=translation, **cameras_kwargs
-            )
+            rotation_matrix = rotation_6d_to_matrix(rotation)
+            cameras = PerspectiveCameras(R=rotation_matrix, T=translation, **cameras_kwargs)
             # synthesis
-            albedos = self.flame_texture(texture_params)
-            pred_images, mask_all, mask_face = self.mesh_render(flame_verts, albedos, cameras)
-            loss_face = pixel_loss(pred_images, batch_data['frames'], mask=mask_face)
-            loss_head = pixel_loss(pred_images, batch_data['frames'], mask=mask_all)
+            pred_images, mask_all, mask_face = self.mesh_render(flame_verts, albedos, cameras, image_size=size)
+            loss_face = pixel_loss(pred_images, frames, mask=mask_face, per_sample=True)
+            loss_head = pixel_loss(pred_images, frames, mask=mask_all, per_sample=True)
             # loss_norm = torch.sum(texture_params ** 2)
             # all_loss = (loss_head + loss_face + loss_norm * 0.0001) * 350
             all_loss = (loss_face + loss_head) * 350
             # lmks
-            points_68 = cameras.transform_points_screen(pred_lmk_68, R=rotation_6d_to_matrix(rotation), T=translation)[..., :2]
-            points_dense = cameras.transform_points_screen(pred_lmk_dense, R=rotation_6d_to_matrix(rotation), T=translation)[..., :2]
-            loss_lmk_68 = lmk_loss(points_68, batch_data['emoca']['lmks'], self.image_size)
-            loss_lmk_dense = lmk_loss(points_dense, batch_data['emoca']['lmks_dense'][:, self.flame_model.mediapipe_idx], self.image_size)
+            points_68, _ = project_points(
+                pred_lmk_68, rotation_matrix, translation, self.focal_length, self.principal_point, self.image_size
+            )
+            points_dense, _ = project_points(
+                pred_lmk_dense, rotation_matrix, translation, self.focal_length, self.principal_point, self.image_size
+            )
+            loss_lmk_68 = lmk_loss(points_68, batch_data['emoca']['lmks'], self.image_size, per_sample=True)
+            loss_lmk_dense = lmk_loss(points_dense, batch_data['emoca']['lmks_dense'][:, self.flame_model.mediapipe_idx], self.image_size, per_sample=True)
             all_loss = all_loss + (loss_lmk_68 + loss_lmk_dense) * 300
-
-            optimizer.zero_grad()
-            all_loss.backward()
-            optimizer.step()
-            scheduler.step()
-            loss = all_loss.item()
             # ### DEBUG
             # print(idx, rotation[0], translation[0], loss)
             # torchvision.utils.save_image(
             #     torch.cat([batch_data['frames'][:4], pred_images[:4]]).cpu(),
             #     './debug.jpg', nrow=4
             # )
+            return all_loss
+        # coarse to fine, the frames are resized once per level
+        sample_steps = 0
+        for size, level_steps in self.pyramid_levels(steps):
+            # the crop keeps the pixel size of the level
+            render_size = size * frames.shape[-1] // self.image_size
+            level_frames = resize_frames(frames, render_size)
+            _, level_sample_steps = run_optimization(
+                lambda: closure(render_size, level_frames), optimizer, level_steps, scheduler=scheduler,
+                rel_tol=self._converge_tol, grad_tol=self._grad_tol,
+                sample_params=[expression_codes, rotation, translation]
+            )
+            sample_steps = sample_steps + level_sample_steps
+        self.step_log.append(sample_steps)
         # gather results
         synthesis_results = {}
         transform_matrix = torch.cat(
@@ -156,18 +258,31 @@ class Synthesis_Engine:
         return synthesis_results
 
 
-def lmk_loss(opt_lmks, target_lmks, image_size, lmk_mask=None):
+def lmk_loss(opt_lmks, target_lmks, image_size, lmk_mask=None, per_sample=False):
     size = torch.tensor([1 / image_size, 1 / image_size], device=opt_lmks.device).float()[None, None, ...]
     diff = torch.pow(opt_lmks - target_lmks, 2)
     if lmk_mask is None:
-        return (diff * size).mean()
+        loss = diff * size
     else:
-        return (diff * size * lmk_mask).mean()
+        loss = diff * size * lmk_mask
+    if per_sample:
+        # share of every sample in the mean
+        return loss.flatten(1).sum(dim=1) / loss.numel()
+    return loss.mean()
+
+def resize_frames(frames, size):
+    # box filter, exact for the power of two levels of the pyramid
+    if frames.shape[-1] == size:
+        return frames
+    return torch.nn.functional.interpolate(frames, size=(size, size), mode='area')
 
-def pixel_loss(opt_img, target_img, mask=None):
+def pixel_loss(opt_img, target_img, mask=None, per_sample=False):
     if mask is None:
         mask = torch.ones_like(opt_img).type_as(opt_img)
     n_pixels = torch.sum((mask[:, 0, ...] > 0).int()).detach().float()
     loss = (mask * (opt_img - target_img)).abs()
+    if per_sample:
+        # share of every sample in the batch loss
+        return loss.flatten(1).sum(dim=1) / n_pixels
     loss = torch.sum(loss) / n_pixels
     return loss
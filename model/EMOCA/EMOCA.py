@@ -29,5 +29,5 @@ class EMOCA(torch.nn.Module):
         codedict['exp'] = expdeca_code
         del codedict['light'], codedict['tex']
         for key in codedict.keys():
-            codedict[key] = codedict[key][0].cpu().half()
+            codedict[key] = codedict[key].cpu().half()
         return codedict
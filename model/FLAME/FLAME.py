@@ -11,7 +11,7 @@ import pickle
 import numpy as np
 import torch.nn as nn
 
-from .lbs import lbs, batch_rodrigues, vertices2landmarks
+from .lbs import lbs, skinning, blend_shapes, vertices2joints, batch_rodrigues, vertices2landmarks
 
 class FLAME(nn.Module):
     """
@@ -86,8 +86,90 @@ class FLAME(nn.Module):
             neck_kin_chain.append(curr_idx)
             curr_idx = self.parents[curr_idx]
         self.register_buffer('neck_kin_chain', torch.stack(neck_kin_chain))
+        # rest pose joints are linear in betas, regress them from the template and the blend shapes once
+        self.register_buffer('J_template', vertices2joints(self.J_regressor, self.v_template[None])[0])
+        self.register_buffer('J_shapedirs', torch.einsum('jv,vkl->jkl', self.J_regressor, self.shapedirs))
         # print("FLAME Model Done.")
 
+    def _register_lmk_subset(self, lmk_faces):
+        # blend shapes and skinning for only the vertices of the landmark faces,
+        # faces_tensor re-indexed into the subset (faces outside of lmk_faces point at vertex 0)
+        lmk_vertex_idx = torch.unique(self.faces_tensor[torch.unique(lmk_faces)].view(-1))
+        subset_idx = torch.zeros(self.v_template.shape[0], dtype=torch.long)
+        subset_idx[lmk_vertex_idx] = torch.arange(lmk_vertex_idx.shape[0])
+        num_pose_basis = self.posedirs.shape[0]
+        self.register_buffer('lmk_faces_subset', subset_idx[self.faces_tensor])
+        self.register_buffer('lmk_v_template', self.v_template[lmk_vertex_idx])
+        self.register_buffer('lmk_shapedirs', self.shapedirs[lmk_vertex_idx])
+        self.register_buffer(
+            'lmk_posedirs', self.posedirs.view(num_pose_basis, -1, 3)[:, lmk_vertex_idx].reshape(num_pose_basis, -1)
+        )
+        self.register_buffer('lmk_lbs_weights', self.lbs_weights[lmk_vertex_idx])
+
+    def bind_identity(self, shape_code):
+        """
+            Fixes the identity: the shaped template and its rest pose joints are computed once,
+            forward / forward_landmarks with shape_params=None then only add the expression blend shapes.
+            Input:
+                shape_code: number of shape parameters (or 1 X number of shape parameters)
+        """
+        shape_code = shape_code.reshape(1, -1).to(self.v_template)
+        if hasattr(self, 'id_shape_code') and torch.equal(self.id_shape_code, shape_code):
+            return
+        n_shape = shape_code.shape[1]
+        self.register_buffer('id_shape_code', shape_code, persistent=False)
+        self.register_buffer(
+            'id_v_template', self.v_template + blend_shapes(shape_code, self.shapedirs[..., :n_shape])[0], persistent=False
+        )
+        self.register_buffer('id_expdirs', self.shapedirs[..., n_shape:].contiguous(), persistent=False)
+        self.register_buffer(
+            'id_J_template', self.J_template + blend_shapes(shape_code, self.J_shapedirs[..., :n_shape])[0], persistent=False
+        )
+        self.register_buffer('id_J_expdirs', self.J_shapedirs[..., n_shape:].contiguous(), persistent=False)
+        if hasattr(self, 'lmk_v_template'):
+            self.register_buffer(
+                'id_lmk_v_template', self.lmk_v_template + blend_shapes(shape_code, self.lmk_shapedirs[..., :n_shape])[0],
+                persistent=False
+            )
+            self.register_buffer('id_lmk_expdirs', self.lmk_shapedirs[..., n_shape:].contiguous(), persistent=False)
+
+    def _build_params(self, shape_params, expression_params, pose_params, eye_pose_params):
+        # without shape_params (bound identity) the betas are only the expression
+        if shape_params is None:
+            assert hasattr(self, 'id_shape_code'), 'call bind_identity first'
+            batch_size = expression_params.shape[0]
+        else:
+            batch_size = shape_params.shape[0]
+        if pose_params is None:
+            pose_params = self.eye_pose.expand(batch_size, -1) # TODO: is this correct?
+        if eye_pose_params is None:
+            eye_pose_params = self.eye_pose.expand(batch_size, -1)
+        if expression_params is None:
+            expression_params = torch.zeros(batch_size, self.cfg.n_exp).to(shape_params.device)
+
+        if shape_params is None:
+            betas = expression_params
+        else:
+            betas = torch.cat([shape_params, expression_params], dim=1)
+        full_pose = torch.cat([
+                pose_params[:, :3], self.neck_pose.expand(batch_size, -1), 
+                pose_params[:, 3:], eye_pose_params
+            ], dim=1
+        )
+        return betas, full_pose
+
+    def _landmarks_68(self, vertices, faces, full_pose):
+        batch_size = vertices.shape[0]
+        lmk_faces_idx = self.lmk_faces_idx.unsqueeze(dim=0).expand(batch_size, -1)
+        lmk_bary_coords = self.lmk_bary_coords.unsqueeze(dim=0).expand(batch_size, -1, -1)
+        dyn_lmk_faces_idx, dyn_lmk_bary_coords = self._find_dynamic_lmk_idx_and_bcoords(
+            full_pose, self.dynamic_lmk_faces_idx,
+            self.dynamic_lmk_bary_coords,
+            self.neck_kin_chain, dtype=self.dtype)
+        lmk_faces_idx = torch.cat([dyn_lmk_faces_idx, lmk_faces_idx], 1)
+        lmk_bary_coords = torch.cat([dyn_lmk_bary_coords, lmk_bary_coords], 1)
+        return vertices2landmarks(vertices, faces, lmk_faces_idx, lmk_bary_coords)
+
     def _find_dynamic_lmk_idx_and_bcoords(
             self, pose, dynamic_lmk_faces_idx, dynamic_lmk_b_coords,
             neck_kin_chain, dtype=torch.float32
@@ -136,45 +218,31 @@ class FLAME(nn.Module):
     def forward(self, shape_params=None, expression_params=None, pose_params=None, eye_pose_params=None):
         """
             Input:
-                shape_params: N X number of shape parameters
+                shape_params: N X number of shape parameters, None for the identity fixed with bind_identity
                 expression_params: N X number of expression parameters
                 pose_params: N X number of pose parameters (6)
             return:d
                 vertices: N X V X 3
                 landmarks: N X number of landmarks X 3
         """
-        batch_size = shape_params.shape[0]
-        if pose_params is None:
-            pose_params = self.eye_pose.expand(batch_size, -1) # TODO: is this correct?
-        if eye_pose_params is None:
-            eye_pose_params = self.eye_pose.expand(batch_size, -1)
-        if expression_params is None:
-            expression_params = torch.zeros(batch_size, self.cfg.n_exp).to(shape_params.device)
-
-        betas = torch.cat([shape_params, expression_params], dim=1)
-        full_pose = torch.cat([
-                pose_params[:, :3], self.neck_pose.expand(batch_size, -1), 
-                pose_params[:, 3:], eye_pose_params
-            ], dim=1
-        )
-        template_vertices = self.v_template.unsqueeze(0).expand(batch_size, -1, -1)
-        vertices, _ = lbs(
-            betas, full_pose, template_vertices,
-            self.shapedirs, self.posedirs, self.J_regressor, self.parents,
-            self.lbs_weights, dtype=self.dtype, detach_pose_correctives=False
-        )
+        betas, full_pose = self._build_params(shape_params, expression_params, pose_params, eye_pose_params)
+        batch_size = full_pose.shape[0]
+        if shape_params is None:
+            v_shaped = self.id_v_template + blend_shapes(betas, self.id_expdirs)
+            J = self.id_J_template + blend_shapes(betas, self.id_J_expdirs)
+            vertices, _ = skinning(
+                v_shaped, J, full_pose, self.posedirs, self.parents, self.lbs_weights,
+                dtype=self.dtype, detach_pose_correctives=False
+            )
+        else:
+            template_vertices = self.v_template.unsqueeze(0).expand(batch_size, -1, -1)
+            vertices, _ = lbs(
+                betas, full_pose, template_vertices,
+                self.shapedirs, self.posedirs, self.J_regressor, self.parents,
+                self.lbs_weights, dtype=self.dtype, detach_pose_correctives=False
+            )
         # find lmk
-        lmk_faces_idx = self.lmk_faces_idx.unsqueeze(dim=0).expand(batch_size, -1)
-        lmk_bary_coords = self.lmk_bary_coords.unsqueeze(dim=0).expand(batch_size, -1, -1)
-        dyn_lmk_faces_idx, dyn_lmk_bary_coords = self._find_dynamic_lmk_idx_and_bcoords(
-            full_pose, self.dynamic_lmk_faces_idx,
-            self.dynamic_lmk_bary_coords,
-            self.neck_kin_chain, dtype=self.dtype)
-        lmk_faces_idx = torch.cat([dyn_lmk_faces_idx, lmk_faces_idx], 1)
-        lmk_bary_coords = torch.cat([dyn_lmk_bary_coords, lmk_bary_coords], 1)
-        landmarks2d = vertices2landmarks(
-            vertices, self.faces_tensor, lmk_faces_idx, lmk_bary_coords
-        )
+        landmarks2d = self._landmarks_68(vertices, self.faces_tensor, full_pose)
         landmarks3d = vertices2landmarks(
             vertices, self.faces_tensor, 
             self.full_lmk_faces_idx.repeat(vertices.shape[0], 1),
@@ -202,12 +270,15 @@ class FLAME_MP(FLAME):
             torch.tensor(lmk_embeddings_mediapipe['lmk_b_coords'], dtype=self.dtype)
         )
         self.mediapipe_idx = lmk_embeddings_mediapipe['landmark_indices'].astype(int)
-        
+        self._register_lmk_subset(torch.cat([
+            self.lmk_faces_idx.view(-1), self.dynamic_lmk_faces_idx.view(-1), self.lmk_faces_idx_mediapipe.view(-1)
+        ]))
+
     def forward(self, shape_params=None, expression_params=None, pose_params=None, eye_pose_params=None):
         vertices, landmarks2d_68, landmarks3d = super().forward(
             shape_params, expression_params, pose_params, eye_pose_params
         )
-        batch_size = shape_params.shape[0]
+        batch_size = vertices.shape[0]
         lmk_faces_idx_mediapipe = self.lmk_faces_idx_mediapipe.unsqueeze(dim=0).expand(batch_size, -1).contiguous()
         lmk_bary_coords_mediapipe = self.lmk_bary_coords_mediapipe.unsqueeze(dim=0).expand(batch_size, -1, -1).contiguous()
         landmarks2d_mediapipe = vertices2landmarks(
@@ -217,6 +288,34 @@ class FLAME_MP(FLAME):
         )
         return vertices, landmarks2d_68, landmarks2d_mediapipe
 
+    def forward_landmarks(self, shape_params=None, expression_params=None, pose_params=None, eye_pose_params=None):
+        """
+            Same landmarks as forward, blend shapes and skinning run only on the landmark vertices.
+            shape_params=None uses the identity fixed with bind_identity.
+            return:
+                landmarks2d_68: N X 68 X 3
+                landmarks2d_mediapipe: N X 105 X 3
+        """
+        betas, full_pose = self._build_params(shape_params, expression_params, pose_params, eye_pose_params)
+        batch_size = full_pose.shape[0]
+        if shape_params is None:
+            v_shaped = self.id_lmk_v_template + blend_shapes(betas, self.id_lmk_expdirs)
+            J = self.id_J_template + blend_shapes(betas, self.id_J_expdirs)
+        else:
+            v_shaped = self.lmk_v_template + blend_shapes(betas, self.lmk_shapedirs)
+            J = self.J_template + blend_shapes(betas, self.J_shapedirs)
+        vertices, _ = skinning(
+            v_shaped, J, full_pose, self.lmk_posedirs, self.parents, self.lmk_lbs_weights,
+            dtype=self.dtype, detach_pose_correctives=False
+        )
+        landmarks2d_68 = self._landmarks_68(vertices, self.lmk_faces_subset, full_pose)
+        landmarks2d_mediapipe = vertices2landmarks(
+            vertices, self.lmk_faces_subset,
+            self.lmk_faces_idx_mediapipe.unsqueeze(dim=0).expand(batch_size, -1).contiguous(),
+            self.lmk_bary_coords_mediapipe.unsqueeze(dim=0).expand(batch_size, -1, -1).contiguous()
+        )
+        return landmarks2d_68, landmarks2d_mediapipe
+
 
 class FLAME_Tex(nn.Module):
     def __init__(self, flame_path, n_tex=140, image_size=512):
@@ -246,8 +345,20 @@ class FLAME_Tex(nn.Module):
             ss = pickle.load(f, encoding='latin1')
             self.masks = Struct(**ss)
 
-    def forward(self, texcode):
-        texture = self.texture_mean + (self.texture_basis * texcode[:, None, :]).sum(-1)
+    def texel_basis(self, texel_mask):
+        # texel_mask: [512, 512] bool, the texels which affect the rendering, see Texture_Renderer.sampled_texels
+        texels = texel_mask.flatten().nonzero()[:, 0].to(self.texture_basis.device)
+        rows = (texels[:, None] * 3 + torch.arange(3, device=texels.device)).flatten()
+        return rows, self.texture_mean[0, :, rows], self.texture_basis[0, rows].contiguous()
+
+    def forward(self, texcode, texels=None):
+        # [B, n_tex] @ [n_tex, rows], no [B, rows, n_tex] intermediate.
+        # texels: texel_basis(), only those texels follow texcode, the others keep the mean texture
+        if texels is None:
+            texture = self.texture_mean[0] + texcode @ self.texture_basis[0].T
+        else:
+            rows, mean, basis = texels
+            texture = self.texture_mean[0].repeat(texcode.shape[0], 1).index_copy(1, rows, mean + texcode @ basis.T)
         texture = texture.reshape(texcode.shape[0], 512, 512, 3).permute(0, 3, 1, 2)
         texture = torch.nn.functional.interpolate(texture, self.image_size, mode='bilinear')
         texture = texture[:, [2, 1, 0], :, :]
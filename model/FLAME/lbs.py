@@ -179,9 +179,6 @@ def lbs(betas, pose, v_template, shapedirs, posedirs, J_regressor, parents,
             The joints of the model
     '''
 
-    batch_size = max(betas.shape[0], pose.shape[0])
-    device = betas.device
-
     # Add shape contribution
     v_shaped = v_template + blend_shapes(betas, shapedirs)
 
@@ -189,6 +186,39 @@ def lbs(betas, pose, v_template, shapedirs, posedirs, J_regressor, parents,
     # NxJx3 array
     J = vertices2joints(J_regressor, v_shaped)
 
+    return skinning(
+        v_shaped, J, pose, posedirs, parents, lbs_weights, pose2rot=pose2rot, dtype=dtype,
+        detach_pose_correctives=detach_pose_correctives
+    )
+
+
+def skinning(v_shaped, J, pose, posedirs, parents, lbs_weights, pose2rot=True, dtype=torch.float32,
+             detach_pose_correctives=True):
+    ''' Pose blend shapes and skinning of already shaped vertices, the second half of lbs
+
+        The joints are given instead of regressed from v_shaped, so v_shaped,
+        posedirs and lbs_weights may hold any subset of the vertices.
+
+        Parameters
+        ----------
+        v_shaped : torch.tensor BxVx3
+            The template vertices with the shape contribution
+        J : torch.tensor BxJx3
+            The rest pose joints of the shaped template
+        pose, posedirs, parents, lbs_weights, pose2rot, dtype:
+            As in lbs, posedirs and lbs_weights for the same vertices as v_shaped
+
+        Returns
+        -------
+        verts: torch.tensor BxVx3
+            The posed vertices
+        joints: torch.tensor BxJx3
+            The joints of the model
+    '''
+
+    batch_size = max(v_shaped.shape[0], pose.shape[0])
+    device = v_shaped.device
+
     # 3. Add pose blend shapes
     # N x J x 3 x 3
     ident = torch.eye(3, dtype=dtype, device=device)
@@ -218,7 +248,7 @@ def lbs(betas, pose, v_template, shapedirs, posedirs, J_regressor, parents,
     # W is N x V x (J + 1)
     W = lbs_weights.unsqueeze(dim=0).expand([batch_size, -1, -1])
     # (N x V x (J + 1)) x (N x (J + 1) x 16)
-    num_joints = J_regressor.shape[0]
+    num_joints = J.shape[1]
     T = torch.matmul(W, A.view(batch_size, num_joints, 16)) \
         .view(batch_size, -1, 4, 4)
 
@@ -31,10 +31,39 @@ if __name__ == "__main__":
     parser.add_argument('--visualization_fps', default=24, type=int)
     parser.add_argument('--remove_buffer', '-r', action='store_true')
     parser.add_argument('--matting_thresh', '-m', default=0.5, type=float)
+    parser.add_argument('--matting_batch', default=4, type=int)
+    parser.add_argument('--ingest_workers', default=4, type=int)
+    parser.add_argument('--lmdb_commit', default=1000, type=int)
+    parser.add_argument('--ingest_segments', default=1, type=int)
+    parser.add_argument('--frame_store', default='lmdb', choices=['lmdb', 'raw'])
+    parser.add_argument('--decode_workers', default=4, type=int)
+    parser.add_argument('--prefetch', default=2, type=int)
+    parser.add_argument('--emoca_batch', default=32, type=int)
+    parser.add_argument('--track_face_box', action='store_true')
+    parser.add_argument('--emoca_workers', default=1, type=int)
+    parser.add_argument('--emoca_overlap', default=8, type=int)
+    parser.add_argument('--lightning_solver', default='adam', choices=['adam', 'lm'])
+    parser.add_argument('--lm_iters', default=10, type=int)
+    parser.add_argument('--warm_start', action='store_true')
+    parser.add_argument('--converge_tol', default=0.0, type=float)
+    parser.add_argument('--grad_tol', default=0.0, type=float)
+    parser.add_argument('--compile_step', action='store_true')
+    parser.add_argument('--single_pass_raster', action='store_true')
+    parser.add_argument('--visible_texels', action='store_true')
+    parser.add_argument('--synthesis_pyramid', default=[], type=int, nargs='*')
+    parser.add_argument('--face_roi', action='store_true')
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--stream_window', default=64, type=int)
+    parser.add_argument('--stream_steps', default=50, type=int)
+    parser.add_argument('--stream_calib_steps', default=300, type=int)
     args = parser.parse_args()
     ### SET DEVICE
     target_device = set_devices(args.device)
     ### TRACK
+    if args.stream:
+        from core.stream_engine import StreamTrackEngine
+        StreamTrackEngine(args, device=target_device).run()
+        sys.exit(0)
     from core.core_engine import TrackEngine
     track_engine = TrackEngine(args, device=target_device)
     if args.remove_buffer:
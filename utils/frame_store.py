@@ -0,0 +1,81 @@
+import os
+import json
+
+import torch
+import numpy as np
+import torchvision
+
+class RawFrameStore:
+    """
+    Fixed-size uint8 frames in a single memory-mapped file plus a json index.
+    Contiguous frame ranges are returned as zero-copy tensor views.
+    """
+    def __init__(self, store_path):
+        with open(os.path.join(store_path, 'index.json')) as f:
+            index = json.load(f)
+        self.frame_shape = tuple(index['frame_shape'])
+        self.names = index['names']
+        self._name_to_idx = {name: idx for idx, name in enumerate(self.names)}
+        # copy-on-write mapping: writable for torch, never written back
+        self._frames = np.memmap(
+            os.path.join(store_path, 'frames.raw'), dtype=np.uint8, mode='c',
+            shape=(len(self.names), *self.frame_shape)
+        )
+
+    def __len__(self, ):
+        return len(self.names)
+
+    def __contains__(self, frame_name):
+        return frame_name in self._name_to_idx
+
+    def get_frame(self, frame_name):
+        idx = self._name_to_idx[frame_name]
+        return torch.from_numpy(self._frames[idx])
+
+    def get_frames(self, frame_names):
+        indices = [self._name_to_idx[name] for name in frame_names]
+        start = indices[0]
+        if indices == list(range(start, start + len(indices))):
+            return torch.from_numpy(self._frames[start:start + len(indices)])
+        return torch.from_numpy(self._frames[np.array(indices)])
+
+    @staticmethod
+    def exists(store_path):
+        return os.path.exists(os.path.join(store_path, 'index.json'))
+
+    @staticmethod
+    def build(store_path, frame_names, frame_iter, frame_shape):
+        os.makedirs(store_path, exist_ok=True)
+        frames = np.memmap(
+            os.path.join(store_path, 'frames.raw'), dtype=np.uint8, mode='w+',
+            shape=(len(frame_names), *frame_shape)
+        )
+        for idx, frame in enumerate(frame_iter):
+            frames[idx] = frame.numpy()
+        frames.flush()
+        del frames
+        # the index is written last, a store without it is incomplete
+        with open(os.path.join(store_path, 'index.json'), 'w') as f:
+            json.dump({'frame_shape': list(frame_shape), 'names': list(frame_names)}, f)
+
+
+def decode_jpeg(image_buf, channel=3):
+    # load image as [channel(RGB), image_height, image_width]
+    _mode = torchvision.io.ImageReadMode.RGB if channel == 3 else torchvision.io.ImageReadMode.GRAY
+    image_buf = torch.tensor(np.frombuffer(image_buf, dtype=np.uint8))
+    return torchvision.io.decode_image(image_buf, mode=_mode)
+
+
+def decode_jpeg_batch(image_bufs, channel=3, pool=None):
+    # decode_image releases the GIL, workers write into one preallocated tensor
+    first = decode_jpeg(image_bufs[0], channel=channel)
+    frames = first.new_empty((len(image_bufs), *first.shape))
+    frames[0] = first
+    def _decode(idx):
+        frames[idx] = decode_jpeg(image_bufs[idx], channel=channel)
+    if pool is None:
+        for idx in range(1, len(image_bufs)):
+            _decode(idx)
+    else:
+        list(pool.map(_decode, range(1, len(image_bufs))))
+    return frames
@@ -0,0 +1,75 @@
+import io
+import os
+import shutil
+
+import lmdb
+import torch
+
+from .result_store import ResultStore
+
+# reserved keys next to the frame results
+FINGERPRINT_KEY = b'__fingerprint__'
+INVALID_KEY = b'__invalid__'
+
+class ResultJournal:
+    """
+    Append-only per-frame result journal (LMDB, one torch-serialized dict per frame).
+    Every append is one committed transaction, so a crashed stage can resume from the
+    frames already in the journal. Several processes may append to the same journal.
+    A journal written for other upstream inputs (fingerprint) or already saved as the
+    stage result (invalidate) is emptied when it is opened.
+    """
+    def __init__(self, journal_path, fingerprint=None, map_size=1099511627776): # Maximum 1T
+        os.makedirs(journal_path, exist_ok=True)
+        self.journal_path = journal_path
+        self._env = lmdb.open(journal_path, map_size=map_size)
+        if fingerprint is not None:
+            self._check_fingerprint(fingerprint)
+
+    def __getstate__(self, ):
+        return {'journal_path': self.journal_path}
+
+    def __setstate__(self, state):
+        self.__init__(state['journal_path'])
+
+    def _check_fingerprint(self, fingerprint):
+        main_db = self._env.open_db()
+        with self._env.begin(write=True) as txn:
+            # journals without a fingerprint have unknown inputs as well
+            if txn.get(INVALID_KEY) is not None or txn.get(FINGERPRINT_KEY) != fingerprint.encode():
+                if txn.stat(main_db)['entries']:
+                    print('Discarding journal {}, its inputs changed or it was saved already.'.format(self.journal_path))
+                txn.drop(main_db, delete=False)
+            txn.put(FINGERPRINT_KEY, fingerprint.encode())
+
+    def done_frames(self, ):
+        with self._env.begin(write=False) as txn:
+            keys = txn.cursor().iternext(values=False)
+            return set([key.decode() for key in keys if key not in (FINGERPRINT_KEY, INVALID_KEY)])
+
+    def append(self, frame_results):
+        with self._env.begin(write=True) as txn:
+            for frame_name, result in frame_results.items():
+                buf = io.BytesIO()
+                torch.save(result, buf)
+                txn.put(frame_name.encode(), buf.getbuffer())
+
+    def read(self, frame_name):
+        with self._env.begin(write=False) as txn:
+            buf = txn.get(frame_name.encode())
+        return torch.load(io.BytesIO(buf), map_location='cpu')
+
+    def compact(self, frame_names):
+        # frame by frame into memory-mapped columns inside the journal, removed with it
+        store_path = os.path.join(self.journal_path, 'columns')
+        ResultStore.write(store_path, frame_names, self.read, meta={})
+        return ResultStore(store_path)
+
+    def invalidate(self, ):
+        # one committed put, the journal is never resumed from afterwards
+        with self._env.begin(write=True) as txn:
+            txn.put(INVALID_KEY, b'1')
+
+    def remove(self, ):
+        self._env.close()
+        shutil.rmtree(self.journal_path)
@@ -0,0 +1,145 @@
+import queue
+import threading
+from concurrent.futures import Future
+
+import lmdb
+
+_STOP = object()
+
+class BackgroundIterator(threading.Thread):
+    """
+    Runs an iterable in a background thread and buffers at most max_size items,
+    so the producer (decoding, loading) overlaps with the consumer.
+    """
+    def __init__(self, iterable, max_size=8):
+        super(BackgroundIterator, self).__init__(daemon=True)
+        self._iterable = iterable
+        self._queue = queue.Queue(maxsize=max_size)
+        self._stop_event = threading.Event()
+        self.start()
+
+    def _put(self, item):
+        while not self._stop_event.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run(self, ):
+        try:
+            for item in self._iterable:
+                if not self._put((item, None)):
+                    return
+        except BaseException as e:
+            self._put((_STOP, e))
+            return
+        self._put((_STOP, None))
+
+    def __iter__(self, ):
+        while True:
+            item, error = self._queue.get()
+            if error is not None:
+                raise error
+            if item is _STOP:
+                return
+            yield item
+
+    def close(self, ):
+        self._stop_event.set()
+        self.join()
+
+    def __enter__(self, ):
+        return self
+
+    def __exit__(self, *exc_info):
+        # also stops the producer when the consumer raises
+        self.close()
+
+
+class LmdbWriter(threading.Thread):
+    """
+    Single writer thread which owns the LMDB write transaction.
+    Values can be bytes-like objects (anything exposing the buffer protocol)
+    or futures resolving to them. They are written in the order they are
+    queued, write_batch items per putmulti and commit_every items per commit.
+    Existing keys are kept, as before. A write error is raised by the next put() and by close().
+    """
+    def __init__(
+            self, lmdb_path, map_size=1099511627776, queue_size=32, commit_every=1000, write_batch=64
+        ): # Maximum 1T
+        super(LmdbWriter, self).__init__(daemon=True)
+        self._lmdb_path = lmdb_path
+        self._map_size = map_size
+        self._commit_every = commit_every
+        self._write_batch = min(write_batch, commit_every)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.counter = 0
+        self.num_bytes = 0
+        self.start()
+
+    def put(self, key, value):
+        # fail the producer right away instead of at close(), after the whole video is decoded
+        if self.error is not None:
+            raise self.error
+        self._queue.put((key, value))
+
+    def close(self, ):
+        self._queue.put(_STOP)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def _flush(self, txn, items):
+        consumed, added = txn.cursor().putmulti(items, dupdata=False, overwrite=False)
+        if added < consumed:
+            print('Exsist! {} frames are skipped.'.format(consumed - added))
+        self.counter += added
+
+    def run(self, ):
+        env, txn = None, None
+        try:
+            env = lmdb.open(self._lmdb_path, map_size=self._map_size)
+            txn = env.begin(write=True)
+        except BaseException as e:
+            # reported by close(), the loop below only drains the queue
+            self.error = e
+        items, uncommitted = [], 0
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            if self.error is not None:
+                # keep draining so that producers never block on a dead writer
+                continue
+            try:
+                key, value = item
+                if isinstance(value, Future):
+                    value = value.result()
+                value = memoryview(value)
+                self.num_bytes += value.nbytes
+                items.append((key.encode(), value))
+                if len(items) >= self._write_batch:
+                    self._flush(txn, items)
+                    uncommitted += len(items)
+                    items = []
+                if uncommitted >= self._commit_every:
+                    txn.commit()
+                    txn = env.begin(write=True)
+                    uncommitted = 0
+            except BaseException as e:
+                self.error = e
+        if self.error is None:
+            try:
+                if len(items):
+                    self._flush(txn, items)
+                txn.commit()
+            except BaseException as e:
+                self.error = e
+                txn.abort()
+        elif txn is not None:
+            txn.abort()
+        if env is not None:
+            env.close()
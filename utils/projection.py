@@ -0,0 +1,16 @@
+import torch
+
+# Batched pinhole projection with the conventions of the pytorch3d PerspectiveCameras used by the tracker
+# (in_ndc=True): ndc focal length and principal point, row-vector points X @ R + T, and the ndc -> screen
+# conversion of a square image, screen = S/2 * (1 - ndc). Matches cameras.transform_points_screen()[..., :2]
+# without building Transform3d chains.
+
+def project_points(points, rotation, translation, focal_length, principal_point, image_size):
+    # points: [B, N, 3], rotation: [B, 3, 3], translation: [B, 3]
+    # focal_length: shared by the batch, [1] or (fx, fy), principal_point: [2] or [B, 2]
+    # -> screen points [B, N, 2], view points [B, N, 3]
+    view_points = points @ rotation + translation[:, None]
+    focal_length = focal_length.reshape(1, 1, -1)
+    principal_point = principal_point.reshape(-1, 1, 2)
+    ndc_points = focal_length * view_points[..., :2] / view_points[..., 2:] + principal_point
+    return image_size / 2 * (1 - ndc_points), view_points
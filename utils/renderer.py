@@ -1,4 +1,6 @@
 import os
+from collections import OrderedDict
+
 import torch
 import torch.nn as nn
 from pytorch3d.io import load_obj
@@ -77,9 +79,11 @@ class Point_Renderer(nn.Module):
 
 
 class Texture_Renderer(nn.Module):
-    def __init__(self, image_size, flame_path, flame_mask=None, device='cpu'):
+    def __init__(self, image_size, flame_path, flame_mask=None, single_pass=False, device='cpu'):
         super(Texture_Renderer, self).__init__()
         self.device = device
+        # single pass: masks_face from the fragments of the head instead of a second rasterization
+        self.single_pass = single_pass
         # objects
         obj_filename = os.path.join(flame_path, 'FLAME_embedding', 'head_template_mesh.obj')
         _, faces, aux = load_obj(obj_filename, load_textures=False)
@@ -92,44 +96,52 @@ class Texture_Renderer(nn.Module):
             image_size=image_size, blur_radius=0.0, faces_per_pixel=1, 
             perspective_correct=True, cull_backfaces=True
         )
-        # flame mask
+        self._raster_settings = {image_size: self.raster_settings}
+        # TexturesUV of the last frozen texture map: (texture_images, batch_size, textures_uv)
+        self._textures_uv = None
+        # flame mask, face membership table: faces with all three vertices in the mask
         if flame_mask is not None:
-            reduced_faces = []
-            for f in self.faces[0]:
-                valid = 0
-                for v in f:
-                    if v.item() in flame_mask:
-                        valid += 1
-                reduced_faces.append(True if valid == 3 else False)
-            reduced_faces = torch.tensor(reduced_faces).to(self.device)
-            self.flame_mask = reduced_faces
+            flame_mask = torch.as_tensor(flame_mask, device=self.device)
+            self.flame_mask = torch.isin(self.faces[0], flame_mask).all(dim=-1)
+
+    def get_raster_settings(self, image_size=None):
+        # same settings at another output size, the ndc cameras do not depend on it
+        if image_size is None:
+            return self.raster_settings
+        if image_size not in self._raster_settings:
+            self._raster_settings[image_size] = RasterizationSettings(
+                image_size=image_size, blur_radius=0.0, faces_per_pixel=1,
+                perspective_correct=True, cull_backfaces=True
+            )
+        return self._raster_settings[image_size]
 
-    def forward(self, vertices_world, texture_images, cameras):
+    def forward(self, vertices_world, texture_images, cameras, image_size=None):
         batch_size = vertices_world.shape[0]
+        raster_settings = self.get_raster_settings(image_size)
         faces = self.faces.expand(batch_size, -1, -1)
-        textures_uv = TexturesUV(
-            maps=texture_images.expand(batch_size, -1, -1, -1).permute(0, 2, 3, 1), 
-            faces_uvs=self.uvfaces.expand(batch_size, -1, -1), 
-            verts_uvs=self.uvverts.expand(batch_size, -1, -1)
-        )
+        textures_uv = self._build_textures(texture_images, batch_size)
         meshes_world = Meshes(verts=vertices_world, faces=faces, textures=textures_uv)
         # phong renderer
-        phong_renderer = MeshRenderer(
-            rasterizer=MeshRasterizer(cameras=cameras, raster_settings=self.raster_settings),
-            shader=SoftPhongShader(device=self.device, cameras=cameras, lights=self.lights)
-        )
-        image_ref = phong_renderer(meshes_world=meshes_world)
+        rasterizer = MeshRasterizer(cameras=cameras, raster_settings=raster_settings)
+        shader = SoftPhongShader(device=self.device, cameras=cameras, lights=self.lights)
+        fragments = rasterizer(meshes_world)
+        image_ref = shader(fragments, meshes_world)
         images = image_ref[..., :3].permute(0, 3, 1, 2)
         masks_all = image_ref[..., 3:].permute(0, 3, 1, 2) > 0.0
         # silhouette renderer
         with torch.no_grad():
-            if hasattr(self, 'flame_mask'):
+            if hasattr(self, 'flame_mask') and self.single_pass:
+                # pix_to_face indexes the packed faces of the batch, [B, H, W, 1]
+                pix_to_face = fragments.pix_to_face[..., 0]
+                masks_face = self.flame_mask[pix_to_face.clamp(min=0) % self.flame_mask.shape[0]]
+                masks_face = (masks_face & (pix_to_face >= 0))[:, None]
+            elif hasattr(self, 'flame_mask'):
                 textures_verts = TexturesVertex(verts_features=vertices_world.new_ones(vertices_world.shape))
                 meshes_masked = Meshes(
                     verts=vertices_world, faces=faces[:, self.flame_mask], textures=textures_verts
                 )
                 silhouette_renderer = MeshRenderer(
-                    rasterizer=MeshRasterizer(cameras=cameras, raster_settings=self.raster_settings),
+                    rasterizer=MeshRasterizer(cameras=cameras, raster_settings=raster_settings),
                     shader=SoftSilhouetteShader()
                 )
                 masks_face = silhouette_renderer(meshes_world=meshes_masked)
@@ -137,3 +149,65 @@ class Texture_Renderer(nn.Module):
             else:
                 masks_face = None
         return images, masks_all, masks_face
+
+    @torch.no_grad()
+    def sampled_texels(self, vertices_world, cameras, size=512, image_size=None):
+        # [size, size] bool, the texels TexturesUV samples (bilinearly) to render these views:
+        # u along the columns, v along the flipped rows, aligned corners
+        batch_size = vertices_world.shape[0]
+        meshes_world = Meshes(verts=vertices_world, faces=self.faces.expand(batch_size, -1, -1))
+        raster_settings = self.get_raster_settings(image_size)
+        fragments = MeshRasterizer(cameras=cameras, raster_settings=raster_settings)(meshes_world)
+        pix_to_face = fragments.pix_to_face[..., 0]
+        visible = pix_to_face >= 0
+        faces_uvs = self.uvverts[0][self.uvfaces[0]]
+        face_idx = pix_to_face[visible] % faces_uvs.shape[0]
+        uvs = (fragments.bary_coords[..., 0, :][visible][..., None] * faces_uvs[face_idx]).sum(dim=1)
+        x = (uvs[:, 0] * (size - 1)).floor().long().clamp(0, size - 2)
+        y = ((1 - uvs[:, 1]) * (size - 1)).floor().long().clamp(0, size - 2)
+        mask = torch.zeros(size * size, dtype=torch.bool, device=self.device)
+        for dx, dy in [(0, 0), (1, 0), (0, 1), (1, 1)]:
+            mask[(y + dy) * size + x + dx] = True
+        return mask.reshape(size, size)
+
+    def _build_textures(self, texture_images, batch_size):
+        cached = self._textures_uv
+        if cached is not None and cached[0] is texture_images and cached[1] == batch_size:
+            return cached[2]
+        textures_uv = TexturesUV(
+            maps=texture_images.expand(batch_size, -1, -1, -1).permute(0, 2, 3, 1), 
+            faces_uvs=self.uvfaces.expand(batch_size, -1, -1), 
+            verts_uvs=self.uvverts.expand(batch_size, -1, -1)
+        )
+        # only frozen maps are reused, optimized ones change every step
+        if not texture_images.requires_grad:
+            self._textures_uv = (texture_images, batch_size, textures_uv)
+        return textures_uv
+
+
+class TextureCache:
+    """
+    Albedo maps of frozen texture codes, keyed on the code. One cache is shared by the synthesis
+    and render engines of a video, so every map is built once for all batches.
+    """
+    def __init__(self, max_size=4):
+        self._max_size = max_size
+        self._albedos = OrderedDict()
+
+    def albedo(self, flame_texture, texture_code):
+        # flame_texture: FLAME_Tex, texture_code: [1, n_tex]
+        texture_code = texture_code.detach()
+        key = (
+            flame_texture.image_size, str(texture_code.device), tuple(texture_code.shape),
+            texture_code.cpu().numpy().tobytes()
+        )
+        if key not in self._albedos:
+            with torch.no_grad():
+                self._albedos[key] = flame_texture(texture_code)
+            if len(self._albedos) > self._max_size:
+                self._albedos.popitem(last=False)
+        self._albedos.move_to_end(key)
+        return self._albedos[key]
+
+    def clear(self, ):
+        self._albedos.clear()
@@ -0,0 +1,128 @@
+import os
+import json
+
+import torch
+import numpy as np
+
+class _ColumnarResults:
+    # one [num_frames, ...] tensor per result field, rows follow self.names
+    def _set_fields(self, names, fields, meta):
+        self.names = list(names)
+        self._name_to_idx = {name: idx for idx, name in enumerate(self.names)}
+        self._fields = fields
+        self.meta = meta
+
+    def __len__(self, ):
+        return len(self.names)
+
+    def __contains__(self, frame_name):
+        return frame_name in self._name_to_idx
+
+    def fields(self, ):
+        return list(self._fields.keys())
+
+    def get_frame(self, frame_name):
+        # cloned, per-frame views would keep (and torch.save) the whole column
+        idx = self._name_to_idx[frame_name]
+        return {k: v[idx].clone() for k, v in self._fields.items()}
+
+    def frame_views(self, ):
+        # per-frame dict-of-dicts sharing the columns, torch.save writes each column once
+        return {name: {k: v[idx] for k, v in self._fields.items()} for idx, name in enumerate(self.names)}
+
+    def gather(self, frame_names):
+        indices = [self._name_to_idx[name] for name in frame_names]
+        start = indices[0]
+        if indices == list(range(start, start + len(indices))):
+            return {k: v[start:start + len(indices)] for k, v in self._fields.items()}
+        indices = torch.tensor(indices)
+        return {k: v.index_select(0, indices) for k, v in self._fields.items()}
+
+
+class ResultStore(_ColumnarResults):
+    """
+    Structure-of-arrays tracking results: one memory-mapped .npy per field, indexed by frame.
+    Entries which are not frames (meta_info, shape_code) are kept in meta.pth.
+    """
+    def __init__(self, store_path):
+        with open(os.path.join(store_path, 'index.json')) as f:
+            index = json.load(f)
+        fields = {}
+        for field in index['fields']:
+            # mode 'c' like RawFrameStore, torch.from_numpy needs a writable array
+            array = np.load(os.path.join(store_path, field+'.npy'), mmap_mode='c')
+            fields[field] = torch.from_numpy(array)
+        meta = torch.load(os.path.join(store_path, 'meta.pth'), map_location='cpu')
+        self._set_fields(index['names'], fields, meta)
+
+    @staticmethod
+    def exists(store_path, source_path=None):
+        # complete, and built from the current source_path if given
+        index_path = os.path.join(store_path, 'index.json')
+        if not os.path.exists(index_path):
+            return False
+        if source_path is None:
+            return True
+        with open(index_path) as f:
+            index = json.load(f)
+        return os.path.exists(source_path) and index.get('source') == _file_stat(source_path)
+
+    @staticmethod
+    def build(store_path, results, frame_names, source_path=None):
+        # results: the per-frame dict-of-dicts written to the stage .pth (source_path)
+        frame_set = set(frame_names)
+        meta = {k: v for k, v in results.items() if k not in frame_set}
+        ResultStore.write(store_path, frame_names, results.__getitem__, meta, source_path=source_path)
+
+    @staticmethod
+    def write(store_path, frame_names, read_frame, meta, source_path=None):
+        # columns are filled one frame at a time, read_frame(frame_name) -> per-frame dict
+        os.makedirs(store_path, exist_ok=True)
+        index_path = os.path.join(store_path, 'index.json')
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        columns = {}
+        for idx, frame_name in enumerate(frame_names):
+            result = read_frame(frame_name)
+            if not len(columns):
+                for field, value in result.items():
+                    columns[field] = np.lib.format.open_memmap(
+                        os.path.join(store_path, field+'.npy'), mode='w+',
+                        dtype=value.detach().cpu().numpy().dtype, shape=(len(frame_names), *value.shape)
+                    )
+            for field, column in columns.items():
+                column[idx] = result[field].detach().cpu().numpy()
+        fields = list(columns.keys())
+        for column in columns.values():
+            column.flush()
+        del columns
+        torch.save(meta, os.path.join(store_path, 'meta.pth'))
+        index = {'names': list(frame_names), 'fields': fields}
+        if source_path is not None:
+            index['source'] = _file_stat(source_path)
+        # exists() checks index.json, so it is only written once the columns are complete
+        with open(index_path, 'w') as f:
+            json.dump(index, f)
+
+
+class PthResultStore(_ColumnarResults):
+    """
+    Compatibility reader for stage results saved only as a dict-of-dicts .pth,
+    the fields are stacked into in-memory columns once.
+    """
+    def __init__(self, pth_path, frame_names):
+        results = torch.load(pth_path, map_location='cpu')
+        frame_names = [name for name in frame_names if name in results]
+        fields = {
+            field: torch.stack([results[name][field] for name in frame_names], dim=0)
+            for field in results[frame_names[0]].keys()
+        }
+        frame_set = set(frame_names)
+        meta = {k: v for k, v in results.items() if k not in frame_set}
+        self._set_fields(frame_names, fields, meta)
+
+
+def _file_stat(path):
+    # mtime and size identify the .pth a store was built from
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]